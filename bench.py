@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import contextlib
+import converter
+import http.server
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from html5lib import (HTMLParser, serializer, treebuilders)
+from quora_date import (DAYS_OF_WEEK, MONTHS_OF_YEAR, DateResolver, parse_quora_date)
+from run_report import Stats
+
+# The origin the answer dates are resolved against
+ORIGIN = 1424000000
+
+# A mix of date strings in the proportions you might find on a Your Content page
+# for an account that has been answering for a few years.
+def make_date_strings(count, seed=0):
+    rng = random.Random(seed)
+    strs = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.01:
+            strs.append('Added %dm ago' % rng.randint(1, 59))
+        elif kind < 0.02:
+            strs.append('Added %dh ago' % rng.randint(1, 23))
+        elif kind < 0.05:
+            strs.append('Added %s' % rng.choice(DAYS_OF_WEEK))
+        elif kind < 0.3:
+            strs.append('Added %s %d' % (rng.choice(MONTHS_OF_YEAR), rng.randint(1, 28)))
+        else:
+            strs.append('Added %s %d, %d' % (rng.choice(MONTHS_OF_YEAR), rng.randint(1, 28), rng.randint(2010, 2018)))
+    return strs
+
+def bench_dates(count):
+    strs = make_date_strings(count)
+    start = time.perf_counter()
+    for s in strs:
+        try:
+            parse_quora_date(ORIGIN, s)
+        except ValueError:
+            pass
+    elapsed = time.perf_counter() - start
+    print('parse_quora_date: %d strings in %.3f s (%.0f strings/s)' % (count, elapsed, count / elapsed))
+    start = time.perf_counter()
+    DateResolver(ORIGIN).resolve_all(strs)
+    elapsed = time.perf_counter() - start
+    print('DateResolver.resolve_all: %d strings in %.3f s (%.0f strings/s)' % (count, elapsed, count / elapsed))
+
+# Generates answer pages that look like Quora's to the converter: a lot of page
+# chrome around an ExpandedAnswer div, whose content has the kinds of elements
+# cleanup_tree deals with, nested in the usual spans and divs.
+class PageGenerator:
+    def __init__(self, base_url, image_count, seed):
+        self.base_url = base_url
+        self.image_count = image_count
+        self.rng = random.Random(seed)
+
+    def text(self):
+        words = ['the', 'answer', 'is', 'not', 'quite', 'that', 'simple', 'because', 'of', 'naïve', 'Fermi', 'estimates', '中文', '&amp;', '&lt;']
+        return ' '.join(self.rng.choice(words) for _ in range(self.rng.randint(3, 40)))
+
+    def inline(self, depth):
+        kind = self.rng.random()
+        if depth > 0 and kind < 0.3:
+            # Quora wraps text in layers of spans
+            return '<span class="qlink_container"><span>%s</span></span>' % self.inline(depth - 1)
+        if kind < 0.4:
+            return '<b>%s</b> <i>%s</i>' % (self.text(), self.text())
+        if kind < 0.5:
+            return '<a href="/profile/User-%d" class="user">User %d</a>' % (self.rng.randint(1, 1000), self.rng.randint(1, 1000))
+        if kind < 0.6:
+            return '<span class="render_latex">[math]\\sum_{k=1}^{%d} k^2[/math]</span>' % self.rng.randint(2, 100)
+        if kind < 0.65:
+            return '<code>%s</code>' % self.text()
+        return self.text()
+
+    def block(self, depth):
+        kind = self.rng.random()
+        if depth > 0 and kind < 0.15:
+            return '<div class="qtext_para_wrapper">%s</div>' % ''.join(self.block(depth - 1) for _ in range(self.rng.randint(1, 3)))
+        if kind < 0.2:
+            n = self.rng.randrange(self.image_count)
+            return ('<div class="qtext_image_wrapper"><img class="landscape qtext_image" src="data:image/gif;base64,R0lGODlh" '
+                    'master_src="%s/img/image-%d.png" alt="image %d"></div>' % (self.base_url, n, n))
+        if kind < 0.25:
+            return ('<div class="VideoEmbed" data-embed="&lt;iframe width=&quot;560&quot; height=&quot;315&quot; '
+                    'src=&quot;//www.youtube.com/embed/v%d&quot; frameborder=&quot;0&quot; allowfullscreen&gt;&lt;/iframe&gt;">'
+                    '<span class="placeholder">video</span></div>' % self.rng.randint(1, 10**6))
+        if kind < 0.3:
+            return '<pre class="prettyprint"><code class="lang-cpp">int main() {\n    return %d &lt; 1;\n}</code></pre>' % self.rng.randint(0, 9)
+        if kind < 0.35:
+            return '<ul><li>%s</li><li>%s</li></ul>' % (self.inline(depth), self.inline(depth))
+        if kind < 0.4:
+            return '<blockquote><p class="qtext_para">%s</p></blockquote>' % self.inline(depth)
+        if kind < 0.42:
+            return '<div class="hidden">%s</div>' % self.text()
+        if kind < 0.45:
+            return '<h2>%s</h2>' % self.text()
+        return '<p class="qtext_para">%s</p>' % ''.join(self.inline(depth) for _ in range(self.rng.randint(1, 5)))
+
+    def chrome(self, count):
+        return ''.join('<div class="RelatedQuestion"><a class="question_link" href="/Question-%d"><span class="link_text">'
+                       '<span class="ui_qtext_rendered_qtext">%s?</span></span></a><span class="meta">%d answers</span></div>'
+                       % (self.rng.randint(1, 10**6), self.text(), self.rng.randint(1, 100)) for _ in range(count))
+
+    def page(self, n):
+        answer = ''.join(self.block(3) for _ in range(self.rng.randint(2, 40)))
+        return ('<!DOCTYPE html><html><head><title>Question %d? - Quora</title><script>var config = {"x": 1};</script>'
+                '<link rel="stylesheet" href="/main.css"></head><body><div class="SiteHeader">%s</div><div class="layout">'
+                '<div class="AnswerBase"><div class="ExpandedAnswer ExpandedContent">%s'
+                '<div class="ContentFooter AnswerFooter"><span>Written 3 years ago</span></div></div></div>'
+                '<div class="RelatedQuestions">%s</div></div></body></html>'
+                % (n, self.chrome(5), answer, self.chrome(self.rng.randint(10, 40)))).encode('utf-8')
+
+    def image(self):
+        return b'\x89PNG\r\n\x1a\n' + bytes(self.rng.getrandbits(8) for _ in range(self.rng.randint(2000, 20000)))
+
+# A synthetic set of answers: the pages the stand-in server serves, the list of
+# answers to give the crawler, and the same pages as the crawler saves them.
+class Corpus:
+    def __init__(self, directory, count, base_url, seed=0):
+        generator = PageGenerator(base_url, max(1, count // 4), seed)
+        self.paths = {}
+        answers = []
+        for n, date_str in enumerate(make_date_strings(count, seed)):
+            path = '/quora.com/Question-%d/answer/Bench-User' % n
+            self.paths[path] = generator.page(n)
+            answers.append([base_url + path, date_str])
+        for n in range(generator.image_count):
+            self.paths['/img/image-%d.png' % n] = generator.image()
+        self.answers_file = directory + '/answers.json'
+        with open(self.answers_file, 'w', encoding='utf-8') as f:
+            json.dump(answers, f)
+        self.raw_dir = directory + '/raw'
+        try:
+            os.mkdir(self.raw_dir)
+        except FileExistsError:
+            sys.exit('[FATAL] %s already contains a corpus' % directory)
+        resolver = DateResolver(ORIGIN)
+        self.pages = []
+        for (url, date_str), date in zip(answers, resolver.resolve_all(a[1] for a in answers)):
+            question = url.split('/')[-3]
+            page_html = self.paths[url[len(base_url):]]
+            with open('%s/%s %s.html' % (self.raw_dir, date, question), 'wb') as f:
+                f.write(page_html)
+            self.pages.append(page_html)
+        self.page_bytes = sum(len(page_html) for page_html in self.pages)
+
+# Serves a corpus over HTTP, taking `latency` seconds to answer each request, like
+# a distant server would.
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, corpus, latency):
+        super().__init__(('127.0.0.1', 0), StandInRequestHandler)
+        self.corpus = corpus
+        self.latency = latency
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+class StandInRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # Otherwise, with keep-alive connections, Nagle's algorithm and delayed ACKs
+        # add tens of milliseconds to each request.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        data = self.server.corpus.paths.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+# Runs a command and prints how long it took, its exit code and its peak RSS (of
+# the largest of its processes, in kilobytes). On Linux, a process starts out with
+# the peak RSS of the process it was forked from, so the command is run from this
+# small process rather than from the benchmark itself, which is much bigger.
+RUN_AND_MEASURE = """
+import os, subprocess, sys, time
+start = time.perf_counter()
+process = subprocess.Popen(sys.argv[1:], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+_, status, usage = os.wait4(process.pid, 0)
+print(time.perf_counter() - start, os.waitstatus_to_exitcode(status), usage.ru_maxrss)
+"""
+
+# Runs one of the scripts and returns how long it took, in seconds, and its peak
+# RSS, in kilobytes.
+def run_script(argv):
+    result = subprocess.run([sys.executable, '-c', RUN_AND_MEASURE, sys.executable] + argv, stdout=subprocess.PIPE, check=True)
+    elapsed, status, peak_rss = result.stdout.split()
+    if int(status) != 0:
+        sys.exit('[FATAL] %s exited with status %s' % (' '.join(argv), status.decode()))
+    return float(elapsed), int(peak_rss)
+
+def report(name, count, byte_count, elapsed, peak_rss=None):
+    line = '%s: %d files in %.2f s (%.1f files/s, %.2f MB/s)' % (name, count, elapsed, count / elapsed, byte_count / elapsed / 1e6)
+    if peak_rss is not None:
+        line += ', peak RSS %.1f MB' % (peak_rss / 1024)
+    print(line)
+
+# Prints the time spent in each stage, as in `timings`, in total and per file.
+def print_timings(timings, count):
+    total = sum(timings.values())
+    for stage, elapsed in timings.items():
+        print('  %-16s %7.3f s  %5.1f%%  %7.2f ms/file' % (stage, elapsed, 100 * elapsed / total if total else 0, 1000 * elapsed / count))
+
+# Prints the time spent in each stage according to the --report a script wrote
+# to `path`, added up over all its threads, and removes the report.
+def print_report_timings(path, count):
+    with open(path, encoding='utf-8') as f:
+        timings = json.load(f)['totals']['timings']
+    os.remove(path)
+    print_timings(collections.OrderedDict(sorted(timings.items(), key=lambda item: -item[1])), count)
+
+def bench_crawler(corpus, server, work_dir, jobs):
+    script = os.path.dirname(os.path.abspath(__file__)) + '/crawler.py'
+    output_dir = work_dir + '/crawled'
+    report_path = work_dir + '/crawler-report.json'
+    elapsed, peak_rss = run_script([script, corpus.answers_file, output_dir, '-t', str(ORIGIN * 1000), '-z', '0', '-j', str(jobs), '--report', report_path])
+    print_report_timings(report_path, len(corpus.pages))
+    report('crawler (-j %d, %.0f ms latency)' % (jobs, server.latency * 1000), len(corpus.pages), corpus.page_bytes, elapsed, peak_rss)
+    shutil.rmtree(output_dir)
+
+# Compares running the crawler and then the converter with running the pipeline,
+# which does both at once.
+def bench_pipeline(corpus, server, work_dir, jobs):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    crawled_dir = work_dir + '/crawled'
+    output_dir = work_dir + '/converted'
+    crawl_elapsed, crawl_peak_rss = run_script([script_dir + '/crawler.py', corpus.answers_file, crawled_dir, '-t', str(ORIGIN * 1000), '-z', '0', '-j', str(jobs)])
+    convert_elapsed, convert_peak_rss = run_script([script_dir + '/converter.py', crawled_dir, output_dir, '-e', 'stream', '-n'])
+    report('crawler, then converter (-j %d, %.0f ms latency)' % (jobs, server.latency * 1000), len(corpus.pages), corpus.page_bytes,
+           crawl_elapsed + convert_elapsed, max(crawl_peak_rss, convert_peak_rss))
+    shutil.rmtree(crawled_dir)
+    shutil.rmtree(output_dir)
+    report_path = work_dir + '/pipeline-report.json'
+    elapsed, peak_rss = run_script([script_dir + '/pipeline.py', corpus.answers_file, output_dir, '-t', str(ORIGIN * 1000), '-z', '0', '-j', str(jobs), '-e', 'stream', '-n', '--report', report_path])
+    print_report_timings(report_path, len(corpus.pages))
+    report('pipeline (-j %d, %.0f ms latency)' % (jobs, server.latency * 1000), len(corpus.pages), corpus.page_bytes, elapsed, peak_rss)
+    shutil.rmtree(output_dir)
+
+def bench_converter(corpus, work_dir, jobs, engine, download):
+    script = os.path.dirname(os.path.abspath(__file__)) + '/converter.py'
+    output_dir = work_dir + '/converted'
+    argv = [script, corpus.raw_dir, output_dir, '-f', '-j', str(jobs), '-e', engine]
+    if not download:
+        argv.append('-n')
+    elapsed, peak_rss = run_script(argv)
+    report('converter (-j %d, %s engine%s)' % (jobs, engine, '' if download else ', no images'), len(corpus.pages), corpus.page_bytes, elapsed, peak_rss)
+    shutil.rmtree(output_dir)
+
+# Times each stage of converting the pages with the DOM engine, in this process.
+def bench_stages(corpus):
+    converter.args = argparse.Namespace(verbose=False, no_download=False, dedupe_images=False, index=None, max_nodes=None)
+    timings = collections.OrderedDict((stage, 0.0) for stage in ['parse', 'locate', 'cleanup', 'serialize'])
+    stream_time = 0.0
+    with contextlib.redirect_stderr(io.StringIO()):
+        for page_html in corpus.pages:
+            start = time.perf_counter()
+            document = HTMLParser(tree=treebuilders.getTreeBuilder('dom')).parse(page_html, default_encoding='utf-8')
+            parsed = time.perf_counter()
+            answer_node = next(node for node in document.getElementsByTagName('div')
+                               if 'ExpandedAnswer' in node.getAttribute('class').split())
+            located = time.perf_counter()
+            body_node = document.createElement('body')
+            converter.cleanup_tree(document, answer_node, body_node, [])
+            cleaned = time.perf_counter()
+            serializer.serialize(body_node, 'dom', 'utf-8', omit_optional_tags=False)
+            serialized = time.perf_counter()
+            timings['parse'] += parsed - start
+            timings['locate'] += located - parsed
+            timings['cleanup'] += cleaned - located
+            timings['serialize'] += serialized - cleaned
+            start = time.perf_counter()
+            converter.convert_page_stream(page_html, '', Stats())
+            stream_time += time.perf_counter() - start
+    print_timings(timings, len(corpus.pages))
+    report('dom engine, in process', len(corpus.pages), corpus.page_bytes, sum(timings.values()))
+    report('stream engine, in process', len(corpus.pages), corpus.page_bytes, stream_time)
+
+parser = argparse.ArgumentParser(description = 'Measure how fast the parts of quora-backup run')
+parser.add_argument('-n', '--count', default=100000, type=int, help='number of date strings to resolve')
+parser.add_argument('-p', '--pages', default=1000, type=int, help='number of answers in the synthetic corpus')
+parser.add_argument('-l', '--latency', default=0.05, type=float, help='time the stand-in server takes to answer each request, in seconds')
+parser.add_argument('-j', '--jobs', default=4, type=int, help='value of --jobs to run the crawler and converter with')
+parser.add_argument('-b', '--benchmarks', default='dates,stages,crawler,converter,pipeline', help='comma-separated list of benchmarks to run, out of dates, stages, crawler, converter and pipeline')
+parser.add_argument('-w', '--work_dir', default=None, help='where to put the corpus, which is kept afterwards (default: a temporary directory, which is removed)')
+
+args = parser.parse_args()
+benchmarks = args.benchmarks.split(',')
+if 'dates' in benchmarks:
+    bench_dates(args.count)
+if set(benchmarks) & {'stages', 'crawler', 'converter', 'pipeline'}:
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='quora-backup-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        # The server has to be listening before the corpus can refer to it.
+        server = StandInServer(None, args.latency)
+        start = time.perf_counter()
+        server.corpus = Corpus(work_dir, args.pages, server.base_url)
+        print('Generated %d answers (%.1f MB) in %.2f s' % (args.pages, server.corpus.page_bytes / 1e6, time.perf_counter() - start))
+        if 'stages' in benchmarks:
+            bench_stages(server.corpus)
+        if 'crawler' in benchmarks:
+            bench_crawler(server.corpus, server, work_dir, 1)
+            bench_crawler(server.corpus, server, work_dir, args.jobs)
+        if 'converter' in benchmarks:
+            for engine in ['dom', 'stream']:
+                bench_converter(server.corpus, work_dir, 1, engine, False)
+                bench_converter(server.corpus, work_dir, args.jobs, engine, False)
+            bench_converter(server.corpus, work_dir, args.jobs, 'stream', True)
+        if 'pipeline' in benchmarks:
+            bench_pipeline(server.corpus, server, work_dir, args.jobs)
+        server.shutdown()
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
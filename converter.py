@@ -1,21 +1,72 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import contextlib
 import errno
+from file_util import (JsonLinesLog, file_sha256, write_file_atomically)
+import gzip
+import html
+import hashlib
 from html5lib import (HTMLParser, serializer, treebuilders, treewalkers)
+from http_pool import (ConnectionPool, RateLimiter)
+import io
+import json
+import multiprocessing
 import os
+from quora_date import filename_date
 import re
+from run_report import (RunReport, Stats, profiled)
+from search_index import SearchIndex
+import shutil
+import sqlite3
 import sys
+import threading
 import time
 import urllib.error
-import urllib.request
+import zlib
 from xml.dom.minidom import Node
 
+# Bump this whenever a change to the converter changes its output, so that
+# answers converted by an older version are converted again.
+CONVERTER_VERSION = 1
+
+PAGE_CSS = ("blockquote { border-left: 2px solid #ddd; color: #666; margin: 0; padding-left: 16px; } "
+            "code, pre { background: #f4f4f4; } "
+            "pre, h2 { margin: 0; } "
+            "ul { margin: 0 0 0 16px; padding: 8px 0; } "
+            "ol { margin: 0 0 0 28px; padding: 8px 0; } "
+            "li { margin: 0 0 8px; } ")
+# Quora now uses MathJax, so set up the configuration object
+MATHJAX_CONFIG = 'window.MathJax = {"showMathMenu":false,"messageStyle":"none","errorSettings":{"style":{"color":"#000000","font-style":"normal"}},"HTML-CSS":{"linebreaks":{"automatic":true,"width":"container"},"EqnChunk":150,"EqnChunkDelay":20},"tex2jax":{"inlineMath":[["[math]","[/math]"]],"displayMath":[],"ignoreClass":"edit_latex|qtext_editor_content|ignore_latex","processClass":"render_latex","processEnvironments":false,"preview":"none"},"TeX":{"noUndefined":{"attributes":{"mathcolor":"red"}},"noErrors":{"multiLine":true,"style":{"max-width":"100%","overflow":"hidden"}},"Macros":{"C":"{\\mathbb{C}}","N":"{\\mathbb{N}}","O":"{\\emptyset}","Q":"{\\mathbb{Q}}","R":"{\\mathbb{R}}","Z":"{\\mathbb{Z}}"}},"fast-preview":{"disabled":true},"Safe":{"allow":{"URLs":"none","classes":"none","cssIDs":"none","styles":"none","fontsize":"none","require":"none"}}};'
+MATHJAX_URL = 'https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.5/MathJax.js?config=TeX-AMS-MML_HTMLorMML,Safe'
+
+# Elements that are kept, but without their attributes
+PLAIN_TAGS = ['b', 'i', 'u', 'h2', 'ol', 'ul', 'li', 'blockquote', 'wbr', 'p']
+
 def log_if_v(msg):
     if args.verbose:
         print('[DEBUG] %s' % msg, file=sys.stderr)
 
+# Yields the descendants of a DOM node in document order, like
+# getElementsByTagName, but without recursing, so that deeply nested answers
+# don't hit Python's recursion limit.
+def iter_descendants(node):
+    stack = [node.firstChild]
+    while len(stack) > 0:
+        child = stack.pop()
+        if child is None:
+            continue
+        stack.append(child.nextSibling)
+        yield child
+        stack.append(child.firstChild)
+
+def iter_elements(node, tag_name):
+    for child in iter_descendants(node):
+        if child.nodeType == Node.ELEMENT_NODE and child.tagName == tag_name:
+            yield child
+
 def get_title_node(document):
-    for node in document.getElementsByTagName('title'):
+    for node in iter_elements(document, 'title'):
         return node
     return None
 
@@ -26,28 +77,67 @@ def get_text_content(node):
             text += text_node.data
     return text
 
+# Raised when an answer has more nodes than --max_nodes allows
+class TooManyNodes(Exception):
+    pass
+
+# Whether a node starts a new piece of text, for counting nodes: adjacent text
+# nodes count as one, as they would be a single piece of text in an ElementTree.
+def starts_text(node):
+    return node.nodeType == Node.TEXT_NODE and (node.previousSibling is None or node.previousSibling.nodeType != Node.TEXT_NODE)
+
+# Counts the elements and pieces of text in a subtree, including its root.
+def count_nodes(node):
+    return 1 + sum(1 for child in iter_descendants(node) if child.nodeType == Node.ELEMENT_NODE or starts_text(child))
+
+# Moves a subtree of the raw page into the converted page. The raw page is thrown
+# away afterwards, so the node isn't removed from its old parent's childNodes,
+# which would take time proportional to the number of its siblings.
+def move_node(node, dest):
+    node.parentNode = None
+    node.previousSibling = None
+    dest.appendChild(node)
+
 # The HTML can mostly be saved as-is. The main changes we want to make are:
 # 1) Remove most <span>s and attributes since they are not needed anymore.
 # 2) Rewrite relative paths ("/Brian-Bi") to full URLs
-# 3) Download a copy of each embedded image
-def cleanup_tree(doc, src, dest):
-    for child in src.childNodes:
+# 3) Point images to local copies. The (URL, filename) pairs of the images are
+#    appended to `images` so that they can be downloaded.
+#
+# cleanup_tree copies the children of `src` into `dest`, making these changes.
+# Instead of recursing into each element, which fails on deeply nested answers,
+# it keeps a stack of the elements whose children are being copied, each with
+# the next child to look at and where to copy it to. Returns the number of nodes
+# (elements and pieces of text) looked at or copied, and raises TooManyNodes if
+# that is more than `max_nodes`.
+def cleanup_tree(doc, src, dest, images, max_nodes=None):
+    node_count = 0
+    stack = [(src.firstChild, dest)]
+    while len(stack) > 0:
+        child, dest = stack.pop()
+        if child is None:
+            continue
+        # Read this before child is moved into the new tree.
+        stack.append((child.nextSibling, dest))
         if child.nodeType == Node.TEXT_NODE:
             # Text nodes can simply be left as-is
+            if starts_text(child):
+                node_count += 1
             dest.appendChild(child.cloneNode(False))
-            continue
-        if child.nodeType != Node.ELEMENT_NODE:
+        elif child.nodeType != Node.ELEMENT_NODE:
             # ???
             raise ValueError()
         # Otherwise, it's an element node.
-        if child.tagName in ['br', 'hr']:
+        elif child.tagName in ['br', 'hr']:
+            node_count += 1
             dest.appendChild(child.cloneNode(False))
-        elif child.tagName in ['b', 'i', 'u', 'h2', 'ol', 'ul', 'li', 'blockquote', 'wbr', 'p']:
+        elif child.tagName in PLAIN_TAGS:
             # This node doesn't need to be modified but its children might.
             # Also, we won't copy over any of its attributes.
+            node_count += 1
             new_node = doc.createElement(child.tagName)
-            cleanup_tree(doc, child, new_node)
             dest.appendChild(new_node)
+            stack.append((child.firstChild, new_node))
         elif child.getAttribute('data-embed') != '':
             # This is a video. We want to copy the data-embed value, which is HTML for an iframe node.
             # So, we have to parse it into a separate document and import the node.
@@ -66,152 +156,452 @@ def cleanup_tree(doc, src, dest):
                 # The video will look really bad if we don't explicitly set the dimensions.
                 new_node.setAttribute('width', '525')
                 new_node.setAttribute('height', '295')
+                node_count += 1
                 dest.appendChild(new_node)
             except Exception:
                 print('[WARNING] Failed to parse video embed code', file=sys.stderr)
                 # Bail out by just copying the original HTML
-                dest.appendChild(child.cloneNode(True))
+                node_count += count_nodes(child)
+                move_node(child, dest)
         elif child.tagName == 'code':
             # Inline code block. Strip the attributes.
+            node_count += 1
             new_node = doc.createElement('code')
             dest.appendChild(new_node)
-            cleanup_tree(doc, child, new_node)
+            stack.append((child.firstChild, new_node))
         elif 'ContentFooter' in child.getAttribute('class') or 'hidden' in child.getAttribute('class'):
             # These are nodes we just want to skip.
-            continue
+            node_count += 1
         elif child.tagName in ['span', 'div']:
             # don't insert a span or div; just insert its contents
-            cleanup_tree(doc, child, dest)
+            node_count += 1
+            stack.append((child.firstChild, dest))
         elif child.tagName == 'a':
             # A link. We only want to copy the href, and pass the rest through.
+            node_count += 1
             new_node = doc.createElement('a')
             href = child.getAttribute('href')
             if href.startswith('/'):
                 href = 'http://quora.com' + href
             new_node.setAttribute('href', href)
             dest.appendChild(new_node)
-            cleanup_tree(doc, child, new_node)
+            stack.append((child.firstChild, new_node))
         elif child.tagName == 'img':
+            node_count += 1
             src = child.getAttribute('master_src')
             if src == '':
                 src = child.getAttribute('src')
             new_node = doc.createElement('img')
-            new_node.setAttribute('src', src)
+            new_node.setAttribute('src', local_image_src(src, images))
             new_node.setAttribute('alt', child.getAttribute('alt'))
-            if args.no_download:
-                dest.appendChild(new_node)
-                continue
-            # Save a copy of the image locally.
-            # If an error occurs, just leave the src pointing to Quora.
-            try:
-                m = re.search('/([^/?]+)(\?|$)', src)
-                if m is None:
-                    raise ValueError()
-                filename = m.group(1)
-                if not filename.endswith('.png'):
-                    filename += '.png'
-                try:
-                    img_fd = os.open(args.output_dir + '/' + filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
-                except OSError as error:
-                    if error.errno == errno.EEXIST:
-                        log_if_v('Image %s has already been saved; skipping' % filename)
-                        new_node.setAttribute('src', filename)
-                        continue
-                    else:
-                        raise
-                log_if_v('Downloading image from %s' % src)
-                closed = False
-                try:
-                    img = urllib.request.urlopen(src).read()
-                    time.sleep(args.delay)
-                    os.write(img_fd, img)
-                    os.close(img_fd)
-                    closed = True
-                except Exception:
-                    os.close(img_fd)
-                    closed = True
-                    try:
-                        os.remove(args.output_dir + '/' + filename)
-                    except:
-                        print('[WARNING] Failed to remove incomplete file %s' % filename, file=sys.stderr)
-                    raise
-                finally:
-                    if not closed:
-                        os.close(img_fd)
-                    # Don't leave the file there; we will retry it next time.
-                # If everything went according to plan, rewrite the src to the local file.
-                new_node.setAttribute('src', filename)
-            except urllib.error.URLError as error:
-                print('[WARNING] Failed to download image from URL %s (%s)' % (src, error.reason), file=sys.stderr)
-            except OSError as error:
-                print('[WARNING] Failed to save image from URL %s to file %s (%s)' % (src, filename, error.strerror), file=sys.stderr)
-            except ValueError:
-                print('[WARNING] Failed to determine image name from URL %s' % src, file=sys.stderr)
-            finally:
-                dest.appendChild(new_node)
+            dest.appendChild(new_node)
         elif child.tagName == 'pre':
             # Block (not inline) code. Quora's HTML already has the desired <pre><code> structure,
             # so we just need to strip the attributes from the <pre>.
+            node_count += 1
             new_node = doc.createElement('pre')
             dest.appendChild(new_node)
-            cleanup_tree(doc, child, new_node)
+            stack.append((child.firstChild, new_node))
         else:
             print('[WARNING] Unrecognized node', file=sys.stderr)
             # Bail out by just copying the original HTML
-            dest.appendChild(child.cloneNode(True))
-
-parser = argparse.ArgumentParser(description = 'Convert answers downloaded from Quora into a more portable HTML format')
-parser.add_argument('input_dir', nargs='?', default='./quora-answers', help='directory containing "raw" answers downloaded from Quora')
-parser.add_argument('output_dir', nargs='?', default='./quora-answers-cooked', help='where to store the images and converted answers')
-parser.add_argument('-d', '--delay', default=0, type=float, help='Time to sleep between downloads, in seconds')
-parser.add_argument('-n', '--no_download', action='store_true', help='Do not save images')
-parser.add_argument('-v', '--verbose', action='store_true', help='be verbose')
-
-global args
-args = parser.parse_args()
-
-# Get a list of answers to convert...
-filenames = list(filter(lambda f: f.endswith('.html'), os.listdir(args.input_dir)))
-filenames.sort()
-if len(filenames) == 0:
-    sys.exit('[FATAL] No .html files found in directory %s', args.input_dir)
-print('Found %d answers' % len(filenames), file=sys.stderr)
-
-log_if_v('Creating directory %s' % args.output_dir)
-try:
-    os.mkdir(args.output_dir, 0o700)
-except OSError as error:
-    if error.errno == errno.EEXIST:
-        log_if_v('Directory already exists')
-    else:
-        # This is the top level, and we have nothing else to do if we failed
-        raise
+            node_count += count_nodes(child)
+            move_node(child, dest)
+        if max_nodes is not None and node_count > max_nodes:
+            raise TooManyNodes()
+    return node_count
 
-for filename in filenames:
-    sys.stderr.flush()
-    print('Filename: ' + filename, file=sys.stderr)
+# Returns the src to use for the image at the URL `src`. Unless image downloads
+# are disabled, this points to the local copy of the image, which will be saved
+# later by the ImageDownloader; if that fails, the src will be pointed back to
+# Quora. The (URL, filename) pair is appended to `images`.
+def local_image_src(src, images):
+    if args.no_download:
+        return src
+    filename = image_filename(src)
+    if filename is None:
+        print('[WARNING] Failed to determine image name from URL %s' % src, file=sys.stderr)
+        return src
+    images.append((src, filename))
+    return filename
+
+# Derives the local filename for an image from its URL, or returns None if it can't.
+# When images are deduplicated, a hash of the URL is added to the name, so that
+# different images that happen to have the same name don't collide.
+def image_filename(src):
+    m = re.search('/([^/?]+)(\?|$)', src)
+    if m is None:
+        return None
+    filename = m.group(1)
+    if filename.endswith('.png'):
+        filename = filename[:-4]
+    if args.dedupe_images:
+        filename += '-' + hashlib.sha256(src.encode('utf-8')).hexdigest()[:8]
+    return filename + '.png'
+
+# Saves converted answers and images as files in output_dir.
+class OutputDirectory:
+    def __init__(self, output_dir):
+        self.dir = output_dir
+
+    def has_answer(self, filename):
+        return os.path.exists(self.dir + '/' + filename)
+
+    def has_image(self, filename):
+        return os.path.exists(self.dir + '/' + filename)
+
+    # Written atomically, so that a crash never leaves a truncated answer behind
+    # for the manifest to take as converted.
+    def save_answer(self, filename, page_html):
+        write_file_atomically(self.dir + '/' + filename, page_html)
+
+    def load_answer(self, filename):
+        with open(self.dir + '/' + filename, 'rb') as saved_page:
+            return saved_page.read()
+
+    def save_image(self, filename, img):
+        write_file_atomically(self.dir + '/' + filename, img)
+
+    def close(self):
+        pass
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (filename TEXT PRIMARY KEY, title TEXT, date TEXT, html BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS answers_by_date ON answers (date);
+CREATE TABLE IF NOT EXISTS images (filename TEXT PRIMARY KEY, sha256 TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS blobs (sha256 TEXT PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS image_urls (url TEXT PRIMARY KEY, sha256 TEXT NOT NULL);
+"""
+
+# Saves converted answers and images into a single SQLite database, instead of
+# one file each. Answers are stored zlib-compressed, with their title and date;
+# each distinct image is stored once, and image filenames map to its hash. Like
+# the ImageStore, it remembers which URLs have been downloaded. Each process
+# opens its own connection, and SQLite takes care of locking between them.
+class OutputArchive:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript(ARCHIVE_SCHEMA)
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchone()
+
+    def has_answer(self, filename):
+        return self.query('SELECT 1 FROM answers WHERE filename = ?', (filename,)) is not None
+
+    def has_image(self, filename):
+        return self.query('SELECT 1 FROM images WHERE filename = ?', (filename,)) is not None
+
+    def save_answer(self, filename, page_html):
+        m = re.search(b'<title>(.*?)</title>', page_html, re.S)
+        title = None if m is None else html.unescape(m.group(1).decode('utf-8'))
+        self.query('INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?)', (filename, title, filename_date(filename), zlib.compress(page_html)))
+
+    def load_answer(self, filename):
+        row = self.query('SELECT html FROM answers WHERE filename = ?', (filename,))
+        if row is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+        return zlib.decompress(row[0])
+
+    # The same interface as the ImageStore's
+    def lookup(self, src):
+        row = self.query('SELECT sha256 FROM image_urls WHERE url = ?', (src,))
+        return None if row is None else row[0]
+
+    def add(self, src, img):
+        sha256 = hashlib.sha256(img).hexdigest()
+        with self.lock:
+            duplicate = self.db.execute('INSERT OR IGNORE INTO blobs VALUES (?, ?)', (sha256, img)).rowcount == 0
+            self.db.execute('INSERT OR REPLACE INTO image_urls VALUES (?, ?)', (src, sha256))
+        return sha256, duplicate
+
+    def link(self, sha256, filename):
+        self.query('INSERT OR REPLACE INTO images VALUES (?, ?)', (filename, sha256))
+
+    def close(self):
+        self.db.close()
+
+# Returns the output that converted answers and images are saved to.
+def open_output():
+    if args.archive is None:
+        return OutputDirectory(args.output_dir)
+    return OutputArchive(args.archive)
+
+# Returns where to keep each distinct image only once, if anywhere: the archive
+# does that anyway, and --dedupe_images uses an ImageStore.
+def open_image_store():
+    if args.archive is not None:
+        return output
+    if args.dedupe_images:
+        return ImageStore(args.output_dir)
+    return None
+
+# Stores each distinct image once, in output_dir/.images, under the SHA-256 hash
+# of its content. The image files that answers refer to are hard links to these.
+# An index maps each URL that has been downloaded to the hash of its content,
+# so a URL that is seen again doesn't have to be downloaded at all.
+class ImageStore:
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.dir = output_dir + '/.images'
+        os.makedirs(self.dir, 0o700, exist_ok=True)
+        self.index = {}
+        self.lock = threading.Lock()
+        # One lock per hash, so that two threads storing the same image from
+        # different URLs don't both write it
+        self.blob_locks = {}
+        try:
+            with open(self.dir + '/index.jsonl', 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.index[entry['url']] = entry['sha256']
+                    except (ValueError, KeyError, TypeError):
+                        pass
+        except FileNotFoundError:
+            pass
+        self.index_file = open(self.dir + '/index.jsonl', 'a', encoding='utf-8')
+
+    # Returns the hash of the image at the URL `src`, if it has been stored.
+    def lookup(self, src):
+        with self.lock:
+            sha256 = self.index.get(src)
+        if sha256 is None or not os.path.exists(self.dir + '/' + sha256):
+            return None
+        return sha256
+
+    # Stores the image downloaded from the URL `src`, and returns its hash.
+    # Returns True as the second value if the image was already in the store.
+    def add(self, src, img):
+        sha256 = hashlib.sha256(img).hexdigest()
+        blob_path = self.dir + '/' + sha256
+        with self.lock:
+            blob_lock = self.blob_locks.setdefault(sha256, threading.Lock())
+        with blob_lock:
+            duplicate = os.path.exists(blob_path)
+            if not duplicate:
+                write_file_atomically(blob_path, img)
+        with self.lock:
+            self.index[src] = sha256
+            self.index_file.write(json.dumps({'url': src, 'sha256': sha256}) + '\n')
+            self.index_file.flush()
+        return sha256, duplicate
+
+    # Makes `filename` in output_dir refer to the stored image with the given hash.
+    def link(self, sha256, filename):
+        blob_path = self.dir + '/' + sha256
+        path = self.output_dir + '/' + filename
+        try:
+            os.link(blob_path, path)
+        except FileExistsError:
+            pass
+        except OSError as error:
+            if error.errno not in (errno.EPERM, errno.EXDEV, errno.EMLINK, errno.ENOTSUP):
+                raise
+            # The file system doesn't let us link it, so fall back to a copy.
+            shutil.copyfile(blob_path, path)
+
+    def close(self):
+        self.index_file.close()
+
+# Downloads images in background threads, so that the network I/O overlaps with
+# parsing the answers. Each local filename is only saved once; later URLs that
+# map to the same filename are assumed to be the same image. But if the download
+# fails, the next URL that maps to it gets a chance instead.
+class ImageDownloader:
+    def __init__(self, output, jobs, delay, stats, store=None):
+        self.output = output
+        self.stats = stats
+        self.store = store
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self.rate_limiter = RateLimiter(delay)
+        self.connection_pool = ConnectionPool()
+        # For each filename: 'saving', 'saved' or 'failed'
+        self.states = {}
+        # For each filename being saved, the other URLs to try if that fails
+        self.waiting = {}
+        # For each filename saved, the URL it was saved from (None if it had
+        # already been saved before this run)
+        self.saved = {}
+        self.failed = set()
+        self.lock = threading.Lock()
+
+    def add(self, src, filename):
+        with self.lock:
+            state = self.states.get(filename)
+            if state == 'saved' or (src, filename) in self.failed:
+                return
+            if state == 'saving':
+                self.waiting[filename].append(src)
+                return
+            self.states[filename] = 'saving'
+            self.waiting[filename] = []
+        if state is None and self.output.has_image(filename):
+            log_if_v('Image %s has already been saved; skipping' % filename)
+            self.stats.count('images_skipped')
+            self.finish(None, filename, True)
+            return
+        if self.store is not None:
+            sha256 = self.store.lookup(src)
+            if sha256 is not None:
+                log_if_v('Image %s found in the image store' % filename)
+                try:
+                    self.store.link(sha256, filename)
+                    self.stats.count('image_store_hits')
+                    self.finish(src, filename, True)
+                    return
+                except OSError as error:
+                    print('[WARNING] Failed to save image from URL %s to file %s (%s)' % (src, filename, error.strerror), file=sys.stderr)
+                    self.stats.fail('image_save')
+                    src = self.finish(src, filename, False)
+                    if src is None:
+                        return
+        self.executor.submit(self.download, src, filename)
+
+    # Downloads the image at `src` into `filename`, and if that fails, the other
+    # URLs that map to the same filename in turn, until one of them succeeds.
+    def download(self, src, filename):
+        while src is not None:
+            src = self.finish(src, filename, self.download_one(src, filename))
+
+    # Returns whether the image was saved.
+    def download_one(self, src, filename):
+        try:
+            with self.stats.time('image_rate_limit'):
+                self.rate_limiter.wait()
+            log_if_v('Downloading image from %s' % src)
+            with self.stats.time('image_download'):
+                img = self.connection_pool.get(src).data
+            self.stats.count('images_downloaded')
+            self.stats.count('image_bytes_downloaded', len(img))
+            with self.stats.time('image_save'):
+                if self.store is None:
+                    self.output.save_image(filename, img)
+                else:
+                    sha256, duplicate = self.store.add(src, img)
+                    if duplicate:
+                        log_if_v('Image %s is a duplicate of an image already stored' % filename)
+                        self.stats.count('image_duplicates')
+                    self.store.link(sha256, filename)
+            return True
+        except urllib.error.URLError as error:
+            print('[WARNING] Failed to download image from URL %s (%s)' % (src, error.reason), file=sys.stderr)
+            self.stats.fail('image_download')
+        except OSError as error:
+            print('[WARNING] Failed to save image from URL %s to file %s (%s)' % (src, filename, error.strerror), file=sys.stderr)
+            self.stats.fail('image_save')
+        return False
+
+    # Records whether saving `filename` from `src` worked. If it didn't, returns
+    # the next URL to try for the same filename, if any.
+    def finish(self, src, filename, saved):
+        with self.lock:
+            if saved:
+                self.states[filename] = 'saved'
+                self.saved[filename] = src
+                del self.waiting[filename]
+                return None
+            self.failed.add((src, filename))
+            waiting = [other for other in self.waiting[filename] if (other, filename) not in self.failed]
+            if len(waiting) == 0:
+                self.states[filename] = 'failed'
+                del self.waiting[filename]
+                return None
+            self.waiting[filename] = waiting[1:]
+            return waiting[0]
+
+    # Waits for all queued downloads to finish, and returns the set of (URL,
+    # filename) pairs of the images that couldn't be saved.
+    def wait(self):
+        self.executor.shutdown(wait=True)
+        self.connection_pool.close()
+        return self.failed
+
+# Returns the serialized start of an <img> tag whose src is `src`, in the form
+# html5lib's serializer produces when the src attribute comes first.
+def img_tag_prefix(src):
+    token = {'type': 'EmptyTag', 'name': 'img', 'namespace': None, 'data': {(None, 'src'): src}}
+    return serializer.HTMLSerializer(omit_optional_tags=False).render(iter([token]), 'utf-8')[:-1] + b' '
+
+# Points the images in a converted answer that couldn't be saved, as given by
+# the set `failed` of (URL, filename) pairs, back to their original URLs.
+# `images` are all the images the answer refers to, in document order, so that
+# each <img> tag gets back its own URL, even if several URLs map to the same
+# filename and only some of them failed. The images in `restored` were pointed
+# back to their URLs by an earlier run; those that are no longer in `failed` are
+# pointed to their local files again. Returns whether the answer was saved.
+def restore_image_urls(filename, images, failed, restored=()):
     try:
-        with open(args.input_dir + '/' + filename, 'rb') as page:
-            page_html = page.read()
+        page_html = output.load_answer(filename)
+        pieces = []
+        start = 0
+        for src, image in images:
+            old_prefix = img_tag_prefix(src if (src, image) in restored else image)
+            i = page_html.find(old_prefix, start)
+            if i < 0:
+                continue
+            pieces.append(page_html[start:i])
+            pieces.append(img_tag_prefix(src if (src, image) in failed else image))
+            start = i + len(old_prefix)
+        pieces.append(page_html[start:])
+        output.save_answer(filename, b''.join(pieces))
+        return True
     except IOError as error:
-        print('[ERROR] Failed to read %s (%s)' % (filename, error.strerror))
-        continue
+        print('[ERROR] Failed to restore image URLs in file %s (%s)' % (filename, error.strerror), file=sys.stderr)
+    except sqlite3.Error as error:
+        print('[ERROR] Failed to restore image URLs in answer %s (%s)' % (filename, error), file=sys.stderr)
+    return False
 
+# The result of converting the raw page of an answer: the converted page, the
+# images it refers to, as (URL, local filename) pairs, its title (None if it has
+# none) and, if the answers are being indexed, its text.
+class ConvertedAnswer:
+    def __init__(self, page_html, images, title, text):
+        self.page_html = page_html
+        self.images = images
+        self.title = title
+        self.text = text
+
+# Returns the text in a stream of tokens, with whitespace collapsed, for the
+# search index. Tags are taken to separate words; adjacent pieces of text are
+# not, since the tree walkers may split a word into several of them (at an
+# entity, for example).
+def token_text(tokens):
+    pieces = []
+    for token in tokens:
+        pieces.append(token['data'] if token['type'] in ('Characters', 'SpaceCharacters') else ' ')
+    return ' '.join(''.join(pieces).split())
+
+# Converts the raw page of an answer using DOM trees: the answer is located in
+# the DOM of the whole page, and cleanup_tree copies it into a new DOM tree,
+# which is then serialized. Returns a ConvertedAnswer, or None if the answer
+# couldn't be found. Raises TooManyNodes if the answer is larger than
+# --max_nodes allows.
+def convert_page_dom(page_html, filename, stats):
     # Get the HTML element containing just the answer itself.
     # Also get the title.
-    parser = HTMLParser(tree=treebuilders.getTreeBuilder('dom'))
-    document = parser.parse(page_html, default_encoding='utf-8')
+    with stats.time('parse'):
+        parser = HTMLParser(tree=treebuilders.getTreeBuilder('dom'))
+        document = parser.parse(page_html, default_encoding='utf-8')
+    start = time.perf_counter()
     title_node = get_title_node(document) 
-    log_if_v('Title: ' + ('(could not be determined)' if title_node is None else get_text_content(title_node)))
+    title = None if title_node is None else get_text_content(title_node)
+    log_if_v('Title: ' + ('(could not be determined)' if title is None else title))
 
     answer_node = None
-    for node in document.getElementsByTagName('div'):
+    for node in iter_elements(document, 'div'):
         if 'ExpandedAnswer' in node.getAttribute('class').split():
             answer_node = node
             break
+    stats.add_time('locate', time.perf_counter() - start)
     if answer_node is None:
         print('[WARNING] Failed to locate answer on page (filename: %s)' % filename, file=sys.stderr)
-        continue
+        return None
 
     # Construct our new page...
     new_page = document.createElement('html')
@@ -221,39 +611,606 @@ for filename in filenames:
     meta_node = document.createElement('meta')
     meta_node.setAttribute('charset', 'utf-8')
     head_node.appendChild(meta_node)
-    css = ("blockquote { border-left: 2px solid #ddd; color: #666; margin: 0; padding-left: 16px; } "
-           "code, pre { background: #f4f4f4; } "
-           "pre, h2 { margin: 0; } "
-           "ul { margin: 0 0 0 16px; padding: 8px 0; } "
-           "ol { margin: 0 0 0 28px; padding: 8px 0; } "
-           "li { margin: 0 0 8px; } ")
     style_node = document.createElement('style')
     style_node.setAttribute('type', 'text/css')
-    style_node.appendChild(document.createTextNode(css))
+    style_node.appendChild(document.createTextNode(PAGE_CSS))
     head_node.appendChild(style_node)
     # Quora now uses MathJax, so set up the configuration object:
     script_node = document.createElement('script')
-    script_text = document.createTextNode('window.MathJax = {"showMathMenu":false,"messageStyle":"none","errorSettings":{"style":{"color":"#000000","font-style":"normal"}},"HTML-CSS":{"linebreaks":{"automatic":true,"width":"container"},"EqnChunk":150,"EqnChunkDelay":20},"tex2jax":{"inlineMath":[["[math]","[/math]"]],"displayMath":[],"ignoreClass":"edit_latex|qtext_editor_content|ignore_latex","processClass":"render_latex","processEnvironments":false,"preview":"none"},"TeX":{"noUndefined":{"attributes":{"mathcolor":"red"}},"noErrors":{"multiLine":true,"style":{"max-width":"100%","overflow":"hidden"}},"Macros":{"C":"{\\mathbb{C}}","N":"{\\mathbb{N}}","O":"{\\emptyset}","Q":"{\\mathbb{Q}}","R":"{\\mathbb{R}}","Z":"{\\mathbb{Z}}"}},"fast-preview":{"disabled":true},"Safe":{"allow":{"URLs":"none","classes":"none","cssIDs":"none","styles":"none","fontsize":"none","require":"none"}}};')
+    script_text = document.createTextNode(MATHJAX_CONFIG)
     script_node.appendChild(script_text)
     head_node.appendChild(script_node)
     # and then load MathJax:
     script_node = document.createElement('script')
     script_node.setAttribute('type', 'text/javascript')
-    script_node.setAttribute('src', 'https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.5/MathJax.js?config=TeX-AMS-MML_HTMLorMML,Safe')
+    script_node.setAttribute('src', MATHJAX_URL)
     head_node.appendChild(script_node)
     new_page.appendChild(head_node)
     body_node = document.createElement('body')
     # This step processes Quora's HTML into a more lightweight and portable form.
-    cleanup_tree(document, answer_node, body_node)
+    images = []
+    with stats.time('cleanup'):
+        node_count = cleanup_tree(document, answer_node, body_node, images, args.max_nodes)
+    stats.count('answer_nodes', node_count)
     new_page.appendChild(body_node)
+    with stats.time('text'):
+        text = token_text(treewalkers.getTreeWalker('dom')(body_node)) if args.index else None
+    with stats.time('serialize'):
+        cooked_html = b'<!DOCTYPE html>' + serializer.serialize(new_page, 'dom', 'utf-8', omit_optional_tags=False)
+    return ConvertedAnswer(cooked_html, images, title, text)
+
+def start_tag(name, attrs):
+    return {'type': 'StartTag', 'name': name, 'namespace': None, 'data': attrs}
+
+def end_tag(name):
+    return {'type': 'EndTag', 'name': name, 'namespace': None}
+
+# Walks an ElementTree like html5lib's own walker does, but faster on wide trees.
+# Each node it hands out is (element, index among its siblings, ancestors, flag),
+# and html5lib's walker finds an ancestor's index again by searching its parent's
+# children whenever it goes back up to it, which makes an answer with thousands
+# of paragraphs take quadratic time. This one keeps the index of each ancestor
+# next to it instead.
+class ETreeWalker(treewalkers.getTreeWalker('etree')):
+    def getFirstChild(self, node):
+        if isinstance(node, tuple):
+            element, index, parents, flag = node
+        else:
+            element, index, parents, flag = node, None, [], None
+        if flag in ('text', 'tail'):
+            return None
+        if element.text:
+            return element, index, parents, 'text'
+        if len(element):
+            parents.append((element, index))
+            return element[0], 0, parents, None
+        return None
+
+    def getNextSibling(self, node):
+        if not isinstance(node, tuple):
+            return None
+        element, index, parents, flag = node
+        if flag == 'text':
+            if len(element):
+                parents.append((element, index))
+                return element[0], 0, parents, None
+            return None
+        if element.tail and flag != 'tail':
+            return element, index, parents, 'tail'
+        if index < len(parents[-1][0]) - 1:
+            return parents[-1][0][index + 1], index + 1, parents, None
+        return None
+
+    def getParentNode(self, node):
+        if not isinstance(node, tuple):
+            return None
+        element, index, parents, flag = node
+        if flag == 'text':
+            return element if not parents else (element, index, parents, None)
+        parent, parent_index = parents.pop()
+        return parent if not parents else (parent, parent_index, parents, None)
+
+# Returns the start tag token of the iframe in the data-embed attribute of a
+# video, with its attributes rewritten like cleanup_tree does, or None if the
+# data-embed attribute doesn't hold an iframe.
+def video_iframe_token(iframe_html):
+    parser = HTMLParser(tree=treebuilders.getTreeBuilder('etree'))
+    html_element = parser.parse(iframe_html)
+    # Like cleanup_tree, we only accept an iframe as the very first node in the body.
+    if html_element.text or len(html_element) < 2 or html_element[0].tail:
+        return None
+    body_element = html_element[1]
+    if body_element.text or len(body_element) == 0:
+        return None
+    token = next(iter(ETreeWalker(body_element[0])))
+    if token['type'] != 'StartTag' or token['name'] != 'iframe':
+        return None
+    attrs = token['data']
+    # Quora uses a protocol-relative URL (//youtube.com/...) so let's make sure we rewrite this.
+    src = attrs.get((None, 'src'), '')
+    if src.startswith('//'):
+        attrs[(None, 'src')] = 'http:' + src
+    # The video will look really bad if we don't explicitly set the dimensions.
+    attrs[(None, 'width')] = '525'
+    attrs[(None, 'height')] = '295'
+    return token
+
+# Converts the raw page of an answer without building a second tree: the page is
+# parsed into a (lightweight) ElementTree, and the token stream produced by
+# html5lib's tree walker is rewritten on the fly, following the same rules as
+# cleanup_tree, into the token stream of the converted page, which is fed
+# straight to the serializer. The result is the same as convert_page_dom's,
+# and so is the way nodes are counted for --max_nodes; when there are too many,
+# it gives up as soon as it notices.
+def convert_page_stream(page_html, filename, stats):
+    with stats.time('parse'):
+        parser = HTMLParser(tree=treebuilders.getTreeBuilder('etree'))
+        document = parser.parse(page_html, default_encoding='utf-8')
+    start = time.perf_counter()
+
+    title_tokens = None
+    title_depth = 0
+    body_tokens = None
+    images = []
+    node_count = 0
+    in_text = False
+    # Each element that is open inside the answer has an entry on this stack,
+    # with what to do with its contents ('answer', 'clean', 'skip' or 'copy'),
+    # and the end tag token to write when it is closed, if any.
+    stack = None
+    for token in ETreeWalker(document):
+        token_type = token['type']
+        # cleanup_tree never sees the title, because it's moved into the new page
+        # first, wherever it is.
+        if title_depth > 0:
+            title_tokens.append(token)
+            if token_type == 'StartTag':
+                title_depth += 1
+            elif token_type == 'EndTag':
+                title_depth -= 1
+            continue
+        if token_type == 'StartTag' and token['name'] == 'title' and title_tokens is None:
+            title_tokens = [token]
+            title_depth = 1
+            continue
+
+        if stack is None:
+            if body_tokens is not None:
+                if title_tokens is not None:
+                    break
+            elif (token_type == 'StartTag' and token['name'] == 'div' and
+                  'ExpandedAnswer' in token['data'].get((None, 'class'), '').split()):
+                body_tokens = []
+                stack = [('answer', None)]
+            continue
+
+        # Count nodes like cleanup_tree does: each element, and each piece of
+        # text, which the tree walker may split into several tokens.
+        mode = stack[-1][0]
+        is_text = token_type in ('Characters', 'SpaceCharacters')
+        if mode != 'skip' and (token_type in ('StartTag', 'EmptyTag') or (is_text and not in_text)):
+            node_count += 1
+            if args.max_nodes is not None and node_count > args.max_nodes:
+                raise TooManyNodes()
+        in_text = is_text
+        if mode == 'skip':
+            if token_type == 'StartTag':
+                stack.append(('skip', None))
+            elif token_type == 'EndTag':
+                _, end_token = stack.pop()
+                if end_token is not None:
+                    body_tokens.append(end_token)
+            continue
+        if mode == 'copy':
+            body_tokens.append(token)
+            if token_type == 'StartTag':
+                stack.append(('copy', None))
+            elif token_type == 'EndTag':
+                stack.pop()
+            continue
+
+        if token_type in ('Characters', 'SpaceCharacters'):
+            # Text nodes can simply be left as-is
+            body_tokens.append(token)
+        elif token_type == 'EndTag':
+            mode, end_token = stack.pop()
+            if end_token is not None:
+                body_tokens.append(end_token)
+            if mode == 'answer':
+                stack = None
+                if title_tokens is not None:
+                    break
+        elif token_type in ('StartTag', 'EmptyTag'):
+            entry = rewrite_tag(token, body_tokens, images)
+            if token_type == 'StartTag':
+                stack.append(entry)
+        elif token_type != 'SerializeError':
+            # ???
+            raise ValueError()
+
+    stats.add_time('rewrite', time.perf_counter() - start)
+    title = None if title_tokens is None else ''.join(token['data'] for token in title_tokens if token['type'] in ('Characters', 'SpaceCharacters'))
+    log_if_v('Title: ' + ('(could not be determined)' if title is None else title))
+    if body_tokens is None:
+        print('[WARNING] Failed to locate answer on page (filename: %s)' % filename, file=sys.stderr)
+        return None
+    stats.count('answer_nodes', node_count)
+
+    # Construct our new page...
+    tokens = [start_tag('html', {}), start_tag('head', {})]
+    if title_tokens is not None:
+        tokens += title_tokens
+    tokens.append({'type': 'EmptyTag', 'name': 'meta', 'namespace': None, 'data': {(None, 'charset'): 'utf-8'}})
+    tokens += [start_tag('style', {(None, 'type'): 'text/css'}), {'type': 'Characters', 'data': PAGE_CSS}, end_tag('style')]
+    tokens += [start_tag('script', {}), {'type': 'Characters', 'data': MATHJAX_CONFIG}, end_tag('script')]
+    tokens += [start_tag('script', {(None, 'type'): 'text/javascript', (None, 'src'): MATHJAX_URL}), end_tag('script')]
+    tokens += [end_tag('head'), start_tag('body', {})]
+    tokens += body_tokens
+    tokens += [end_tag('body'), end_tag('html')]
+    with stats.time('text'):
+        text = token_text(body_tokens) if args.index else None
+    with stats.time('serialize'):
+        cooked_html = b'<!DOCTYPE html>' + serializer.HTMLSerializer(omit_optional_tags=False).render(iter(tokens), 'utf-8')
+    return ConvertedAnswer(cooked_html, images, title, text)
+
+# The streaming counterpart of one step of cleanup_tree: appends the tokens to
+# write for the start of the element whose start tag token is `token`, and
+# returns the stack entry for the element (see convert_page_stream).
+def rewrite_tag(token, body_tokens, images):
+    name = token['name']
+    attrs = token['data']
+    if name in ['br', 'hr']:
+        # The element is copied, but not its contents.
+        body_tokens.append(token)
+        return ('skip', {'type': 'EndTag', 'name': name, 'namespace': token['namespace']})
+    elif name in PLAIN_TAGS:
+        body_tokens.append(start_tag(name, {}))
+        return ('clean', end_tag(name))
+    elif attrs.get((None, 'data-embed'), '') != '':
+        try:
+            iframe_token = video_iframe_token(attrs[(None, 'data-embed')])
+        except Exception:
+            iframe_token = None
+        if iframe_token is not None:
+            body_tokens.append(iframe_token)
+            body_tokens.append({'type': 'EndTag', 'name': 'iframe', 'namespace': iframe_token['namespace']})
+            return ('skip', None)
+        print('[WARNING] Failed to parse video embed code', file=sys.stderr)
+        # Bail out by just copying the original HTML
+        body_tokens.append(token)
+        return ('copy', None)
+    elif name == 'code':
+        body_tokens.append(start_tag('code', {}))
+        return ('clean', end_tag('code'))
+    elif 'ContentFooter' in attrs.get((None, 'class'), '') or 'hidden' in attrs.get((None, 'class'), ''):
+        return ('skip', None)
+    elif name in ['span', 'div']:
+        return ('clean', None)
+    elif name == 'a':
+        href = attrs.get((None, 'href'), '')
+        if href.startswith('/'):
+            href = 'http://quora.com' + href
+        body_tokens.append(start_tag('a', {(None, 'href'): href}))
+        return ('clean', end_tag('a'))
+    elif name == 'img':
+        src = attrs.get((None, 'master_src'), '')
+        if src == '':
+            src = attrs.get((None, 'src'), '')
+        body_tokens.append({'type': 'EmptyTag', 'name': 'img', 'namespace': None,
+                            'data': {(None, 'src'): local_image_src(src, images), (None, 'alt'): attrs.get((None, 'alt'), '')}})
+        return ('skip', None)
+    elif name == 'pre':
+        body_tokens.append(start_tag('pre', {}))
+        return ('clean', end_tag('pre'))
+    else:
+        print('[WARNING] Unrecognized node', file=sys.stderr)
+        # Bail out by just copying the original HTML
+        body_tokens.append(token)
+        return ('copy', None)
+
+# Returns the path of the raw page in input_dir that the answer in `filename` is
+# converted from. It may have been saved gzipped, as pipeline.py --compress_raw
+# does, under the same name with .gz added.
+def raw_page_path(filename):
+    path = args.input_dir + '/' + filename
+    if not os.path.exists(path) and os.path.exists(path + '.gz'):
+        return path + '.gz'
+    return path
+
+# Converts a single answer from input_dir, saving the result to the output.
+# Returns the images the answer refers to, as (URL, local filename) pairs, or None
+# if the answer couldn't be converted. Where the time went is added to `stats`.
+# If the raw page is given as `page_html`, it isn't read from input_dir.
+def convert_file(filename, stats, page_html=None):
+    sys.stderr.flush()
+    print('Filename: ' + filename, file=sys.stderr)
+    if page_html is None:
+        try:
+            with stats.time('read'):
+                path = raw_page_path(filename)
+                with open(path, 'rb') as page:
+                    page_html = page.read()
+                if path.endswith('.gz'):
+                    page_html = gzip.decompress(page_html)
+        except (EOFError, zlib.error, gzip.BadGzipFile) as error:
+            print('[ERROR] Failed to decompress %s (%s)' % (filename, error), file=sys.stderr)
+            stats.fail('read')
+            return None
+        except IOError as error:
+            print('[ERROR] Failed to read %s (%s)' % (filename, error.strerror))
+            stats.fail('read')
+            return None
+        stats.count('bytes_read', len(page_html))
+
+    try:
+        if args.engine == 'stream':
+            converted = convert_page_stream(page_html, filename, stats)
+        else:
+            converted = convert_page_dom(page_html, filename, stats)
+    except TooManyNodes:
+        print('[ERROR] Answer %s has more than %d nodes; skipping it' % (filename, args.max_nodes), file=sys.stderr)
+        stats.fail('too_many_nodes')
+        return None
+    if converted is None:
+        stats.fail('no_answer')
+        return None
+
     # Okay! Finally, save the HTML.
-    walker = treewalkers.getTreeWalker('dom')(new_page)
     try:
-        with open(args.output_dir + '/' + filename, 'wb', 0o600) as saved_page:
-            saved_page.write(b'<!DOCTYPE html>')
-            saved_page.write(serializer.serialize(new_page, 'dom', 'utf-8', omit_optional_tags=False))
+        with stats.time('save'):
+            output.save_answer(filename, converted.page_html)
     except IOError as error:
         print('[ERROR] Failed to save to file %s (%s)' % (filename, error.strerror), file=sys.stderr)
+        stats.fail('save')
+        return None
+    except sqlite3.Error as error:
+        print('[ERROR] Failed to save answer %s to the archive (%s)' % (filename, error), file=sys.stderr)
+        stats.fail('save')
+        return None
+    stats.count('bytes_written', len(converted.page_html))
+    stats.count('converted')
+    if args.index:
+        try:
+            with stats.time('index'):
+                search_index.add(filename, converted.title, converted.text)
+        except sqlite3.Error as error:
+            print('[WARNING] Failed to add answer to the search index (%s)' % error, file=sys.stderr)
+            stats.fail('index')
+    return converted.images
+
+# Records, for each answer that has been converted, the size, modification time
+# and hash of the raw page it was converted from, the settings it was converted
+# with, and the images it refers to. This lets later runs skip answers that
+# haven't changed without even parsing them.
+# The manifest file is a JsonLinesLog of these entries.
+class Manifest:
+    def __init__(self, path):
+        self.log = JsonLinesLog(path, 'filename')
+        if self.log.malformed > 0:
+            log_if_v('Ignored %d malformed manifest lines' % self.log.malformed)
+        self.entries = self.log.entries
+        self.pending = {}
+
+    def new_entry(self, filename):
+        stat = os.stat(raw_page_path(filename))
+        return {'filename': filename, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'settings': converter_settings()}
+
+    # Returns True if the answer in `filename` was already converted from the same
+    # raw page, with the same settings.
+    def is_current(self, filename):
+        new_entry = self.new_entry(filename)
+        self.pending[filename] = new_entry
+        entry = self.entries.get(filename)
+        if entry is None or not same_settings(entry['settings'], new_entry['settings']) or not output.has_answer(filename):
+            return False
+        if entry['size'] == new_entry['size'] and entry['mtime_ns'] == new_entry['mtime_ns']:
+            return True
+        # The raw page was touched (e.g. downloaded again); it only needs to be
+        # converted again if its content has changed.
+        new_entry['sha256'] = file_sha256(raw_page_path(filename))
+        if entry['sha256'] == new_entry['sha256']:
+            self.record(filename, entry['images'], self.failed_images(filename))
+            return True
+        return False
+
+    # Returns the images, as (URL, local filename) pairs, that the answer in
+    # `filename` refers to, and those of them that couldn't be saved when it was
+    # last converted.
+    def images(self, filename):
+        return [tuple(image) for image in self.entries[filename]['images']]
+
+    def failed_images(self, filename):
+        return {tuple(image) for image in self.entries[filename].get('failed_images', [])}
+
+    # Records that the answer in `filename` has been converted and refers to the
+    # given images, of which those in `failed_images` couldn't be saved and point
+    # back to their URLs.
+    def record(self, filename, images, failed_images=()):
+        entry = self.pending.pop(filename, None)
+        try:
+            if entry is None:
+                entry = self.new_entry(filename)
+            if 'sha256' not in entry:
+                entry['sha256'] = file_sha256(raw_page_path(filename))
+        except OSError as error:
+            print('[WARNING] Failed to record %s in the manifest (%s)' % (filename, error.strerror), file=sys.stderr)
+            return
+        entry['images'] = images
+        if len(failed_images) > 0:
+            entry['failed_images'] = sorted(failed_images)
+        self.log.write(entry)
+
+    def close(self):
+        self.log.close()
+
+def converter_settings():
+    settings = {'version': CONVERTER_VERSION, 'no_download': args.no_download, 'dedupe_images': args.dedupe_images}
+    # So that answers converted before they were being indexed get indexed too
+    if args.index:
+        settings['index'] = os.path.abspath(args.index)
+    return settings
+
+# Answers that were indexed before don't need to be converted again just because
+# they aren't being indexed now.
+def same_settings(old_settings, new_settings):
+    if 'index' not in new_settings:
+        old_settings = dict(old_settings)
+        old_settings.pop('index', None)
+    return old_settings == new_settings
+
+# Process pool workers can't share our stderr, so they hand back what they would
+# have printed, so that the messages for each answer still come out in order.
+def init_worker(worker_args):
+    global args, output, search_index
+    args = worker_args
+    output = open_output()
+    if args.index:
+        search_index = SearchIndex(args.index)
+
+def convert_file_in_worker(filename, page_html=None):
+    messages = io.StringIO()
+    stats = Stats()
+    with contextlib.redirect_stderr(messages):
+        images = convert_file(filename, stats, page_html)
+    return messages.getvalue(), images, stats.as_dict()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Convert answers downloaded from Quora into a more portable HTML format')
+    parser.add_argument('input_dir', nargs='?', default='./quora-answers', help='directory containing "raw" answers downloaded from Quora')
+    parser.add_argument('output_dir', nargs='?', default='./quora-answers-cooked', help='where to store the images and converted answers')
+    parser.add_argument('-d', '--delay', default=0, type=float, help='Minimum time between the start of two image downloads, in seconds')
+    parser.add_argument('-n', '--no_download', action='store_true', help='Do not save images')
+    parser.add_argument('-v', '--verbose', action='store_true', help='be verbose')
+    parser.add_argument('-j', '--jobs', default=1, type=int, help='Number of answers to convert in parallel, using separate processes')
+    parser.add_argument('--download_jobs', default=4, type=int, help='Number of images to download concurrently')
+    parser.add_argument('--dedupe_images', action='store_true', help='Store each distinct image only once, and never download the same URL twice')
+    parser.add_argument('-e', '--engine', choices=['dom', 'stream'], default='dom', help='How to process the HTML: "dom" builds DOM trees of the raw and converted pages; "stream" rewrites the token stream of the raw page directly, which is faster and uses less memory')
+    parser.add_argument('-a', '--archive', default=None, help='Save the converted answers and images into this SQLite database, instead of output_dir')
+    parser.add_argument('-i', '--index', default=None, help='Add the converted answers to the full-text search index in this SQLite database, for search.py')
+    parser.add_argument('-f', '--force', action='store_true', help='Convert all answers, even those that have not changed since the last run')
+    parser.add_argument('--max_nodes', default=None, type=int, help='Skip answers with more than this many elements and pieces of text, instead of converting them')
+    parser.add_argument('--report', default=None, help='Write a JSON report of where the time went, per answer and in total, to this file')
+    parser.add_argument('--profile', default=None, help='Save a cProfile profile of the run to this file (only the main process is profiled, so use it with --jobs=1)')
+
+    args = parser.parse_args()
+    report = RunReport('converter')
+
+    # Get a list of answers to convert... Gzipped raw pages are converted into
+    # answers without the .gz.
+    filenames = set()
+    for f in os.listdir(args.input_dir):
+        if f.endswith('.html.gz'):
+            f = f[:-len('.gz')]
+        if f.endswith('.html'):
+            filenames.add(f)
+    filenames = sorted(filenames)
+    if len(filenames) == 0:
+        sys.exit('[FATAL] No .html or .html.gz files found in directory %s' % args.input_dir)
+    print('Found %d answers' % len(filenames), file=sys.stderr)
+
+    if args.archive is None:
+        log_if_v('Creating directory %s' % args.output_dir)
+        try:
+            os.mkdir(args.output_dir, 0o700)
+        except OSError as error:
+            if error.errno == errno.EEXIST:
+                log_if_v('Directory already exists')
+            else:
+                # This is the top level, and we have nothing else to do if we failed
+                raise
+        manifest_path = args.output_dir + '/.manifest.jsonl'
+    else:
+        log_if_v('Opening archive %s' % args.archive)
+        manifest_path = args.archive + '.manifest.jsonl'
+    output = open_output()
+    if args.index:
+        log_if_v('Opening search index %s' % args.index)
+        search_index = SearchIndex(args.index)
+
+    # Skip the answers that haven't changed since the last run.
+    manifest = Manifest(manifest_path)
+    # Unchanged answers that refer to images that couldn't be saved last time are
+    # not converted again; only those images are retried.
+    retried_answers = []
+    if not args.force:
+        unchanged_count = 0
+        changed_filenames = []
+        for filename in filenames:
+            try:
+                if manifest.is_current(filename):
+                    log_if_v('Answer %s has not changed; skipping' % filename)
+                    unchanged_count += 1
+                    report.run_stats.count('unchanged')
+                    if not args.no_download and len(manifest.failed_images(filename)) > 0:
+                        retried_answers.append(filename)
+                    continue
+            except OSError:
+                # We will report the error when we fail to convert it
+                pass
+            changed_filenames.append(filename)
+        filenames = changed_filenames
+        print('Skipping %d unchanged answers' % unchanged_count, file=sys.stderr)
+
+    # Images are downloaded while later answers are still being converted.
+    # answer_images remembers which answers refer to which images, so that we can
+    # point them back to Quora if the download fails. Those answers are only
+    # recorded in the manifest once their images have been saved.
+    if not args.no_download:
+        store = open_image_store()
+        downloader = ImageDownloader(output, args.download_jobs, args.delay, report.run_stats, store)
+        for filename in retried_answers:
+            for src, image in manifest.failed_images(filename):
+                # If the file exists, it was saved from another URL, and this
+                # one can't have it.
+                if not output.has_image(image):
+                    log_if_v('Retrying image %s from answer %s' % (src, filename))
+                    report.run_stats.count('images_retried')
+                    downloader.add(src, image)
+    answer_images = {}
+    def finish_answer(filename, images):
+        if images is None:
+            return
+        if args.no_download or len(images) == 0:
+            manifest.record(filename, images)
+            return
+        answer_images[filename] = images
+        for src, image in images:
+            downloader.add(src, image)
+
+    with profiled(args.profile):
+        if args.jobs > 1:
+            # Fork would copy the image downloader's threads' locks, and its pooled
+            # connections, in whatever state they happen to be in, so start the
+            # workers afresh.
+            context = multiprocessing.get_context('spawn')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, mp_context=context, initializer=init_worker, initargs=(args,)) as executor:
+                for filename, (messages, images, stats) in zip(filenames, executor.map(convert_file_in_worker, filenames)):
+                    sys.stderr.write(messages)
+                    report.add_file(filename, stats)
+                    finish_answer(filename, images)
+        else:
+            for filename in filenames:
+                stats = Stats()
+                images = convert_file(filename, stats)
+                report.add_file(filename, stats.as_dict())
+                finish_answer(filename, images)
 
-print('Done', file=sys.stderr)
+        if not args.no_download:
+            log_if_v('Waiting for image downloads to finish')
+            with report.run_stats.time('image_wait'):
+                failed = downloader.wait()
 
+    if not args.no_download:
+        if len(failed) > 0:
+            print('Failed to save %d images; pointing them back to Quora' % len(failed), file=sys.stderr)
+        for filename, images in answer_images.items():
+            failed_images = {image for image in images if image in failed}
+            # Recorded in the manifest along with the images that failed, so that
+            # next time we only retry those.
+            if len(failed_images) == 0 or restore_image_urls(filename, images, failed):
+                manifest.record(filename, images, failed_images)
+        for filename in retried_answers:
+            images = manifest.images(filename)
+            restored = manifest.failed_images(filename)
+            still_failed = {(src, image) for src, image in restored if downloader.saved.get(image) != src}
+            if still_failed != restored:
+                log_if_v('Pointing answer %s to the images saved this time' % filename)
+                if restore_image_urls(filename, images, still_failed, restored):
+                    manifest.record(filename, images, still_failed)
+        if store is not None:
+            print('Found %d images in the image store; %d downloaded images were duplicates' % (report.run_stats.counts['image_store_hits'], report.run_stats.counts['image_duplicates']), file=sys.stderr)
+            if store is not output:
+                store.close()
+        print('Opened %d connections, reused them %d times' % (downloader.connection_pool.opened, downloader.connection_pool.reused), file=sys.stderr)
+        report.run_stats.count('connections_opened', downloader.connection_pool.opened)
+        report.run_stats.count('connections_reused', downloader.connection_pool.reused)
+    manifest.close()
+    output.close()
+    if args.index:
+        search_index.close()
+    if args.report is not None:
+        try:
+            report.write(args.report, vars(args))
+        except IOError as error:
+            print('[ERROR] Failed to write report to %s (%s)' % (args.report, error.strerror), file=sys.stderr)
+    print('Done', file=sys.stderr)
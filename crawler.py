@@ -1,131 +1,314 @@
 #!/usr/bin/env python3
 import argparse
+import collections
+import concurrent.futures
 import errno
+from file_util import (JsonLinesLog, file_sha256, write_file_atomically)
+import hashlib
+from http_pool import (ConnectionPool, RateLimiter)
 import json
 import os
+from quora_date import DateResolver
 import re
+from run_report import (RunReport, Stats, profiled)
 import sys
+import threading
 import time
 import urllib.error
-import urllib.request
+
+# How much of the input file to read at a time
+INPUT_CHUNK_SIZE = 65536
+# Where the state of each URL is recorded, inside output_dir
+JOURNAL_NAME = '.crawl_journal.jsonl'
 
 def log_if_v(msg):
     if args.verbose:
         print('[DEBUG] %s' % msg, file=sys.stderr)
 
-# Given origin (timestamp offset by time zone) and string from Quora, e.g.
-# "Added 31 Jan", returns a string such as '2015-01-31'.
-# Quora's short date strings don't provide enough information to determine the
-# exact time, unless it was within the last day, so we won't bother to be any
-# more precise.
-def parse_quora_date(origin, quora_str):
-    days_of_week = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
-    months_of_year = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-    _, _, date_str = quora_str.partition('Added ')
-    date_str = date_str.strip()
-    if date_str == '':
-        raise ValueError('"%s" does not appear to indicate when answer was added' % quora_str)
-    m0 = re.match('just now$', date_str)
-    m1 = re.match('(\d+)m ago$', date_str)
-    m2 = re.match('(\d+)h ago$', date_str)
-    m3 = re.match('(' + '|'.join(days_of_week) + ')$', date_str)
-    m4 = re.match('(' + '|'.join(months_of_year) + ') (\d+)$', date_str)
-    m5 = re.match('(' + '|'.join(months_of_year) + ') (\d+), (\d+)$', date_str)
-    m6 = re.match('(\d+)[ap]m$', date_str)
-    if not m0 is None or not m6 is None:
-        # Using origin for time in am / pm since the time of the day will be discarded anyway
-        tm = time.gmtime(origin)
-    elif not m1 is None:
-        tm = time.gmtime(origin - 60*int(m1.group(1)))
-    elif not m2 is None:
-        tm = time.gmtime(origin - 3600*int(m2.group(1)))
-    elif not m3 is None:
-        # Walk backward until we reach the given day of the week
-        day_of_week = days_of_week.index(m3.group(1))
-        offset = 1
-        while offset <= 7:
-            tm = time.gmtime(origin - 86400*offset)
-            if tm.tm_wday == day_of_week:
+# print() writes a message and the newline after it separately, so lines printed
+# by different threads can get mixed up. This holds on to what each thread writes
+# until it has whole lines, and writes those all at once.
+class LineBufferedWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        lines, newline, rest = (getattr(self.local, 'partial', '') + text).rpartition('\n')
+        self.local.partial = rest
+        if newline:
+            with self.lock:
+                self.stream.write(lines + newline)
+        return len(text)
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+# Reads answers from the input file one at a time, so that we can start
+# downloading before the whole file has been read. The input is either a JSON
+# list of answers, as produced by the snippet in the README, or a file with one
+# JSON-encoded answer per line. Entries are yielded without checking that they
+# are well-formed. A line that isn't valid JSON is yielded as None; malformed
+# JSON inside a list raises ValueError, since we can't tell where the next
+# entry starts.
+class AnswerReader:
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        chunk = self.input_file.read(INPUT_CHUNK_SIZE)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        self.eof = chunk == ''
+
+    # Returns the first non-whitespace character at least `offset` characters
+    # past the current position, and its offset; the character is '' at the end
+    # of the input.
+    def peek(self, offset=0):
+        while True:
+            while self.pos + offset < len(self.buf) and self.buf[self.pos + offset].isspace():
+                offset += 1
+            if self.pos + offset < len(self.buf) or self.eof:
+                return self.buf[self.pos + offset:self.pos + offset + 1], offset
+            self.read_more()
+
+    def skip_whitespace(self):
+        c, offset = self.peek()
+        self.pos += offset
+        return c
+
+    def decode(self):
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # If the value ends exactly where our buffer does, it might continue
+                # in the part of the file we haven't read yet.
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+    # Returns the rest of the current line, without the newline.
+    def read_line(self):
+        pieces = []
+        while True:
+            end = self.buf.find('\n', self.pos)
+            if end >= 0:
+                pieces.append(self.buf[self.pos:end])
+                self.pos = end + 1
                 break
-            offset += 1
-        else:
-            raise ValueError('date "%s" is invalid' % date_str)
-    elif not m4 is None:
-        # Walk backward until we reach the given month and year
-        month_of_year = months_of_year.index(m4.group(1)) + 1
-        day_of_month = int(m4.group(2))
-        offset = 1
-        while offset <= 366:
-            tm = time.gmtime(origin - 86400*offset)
-            if tm.tm_mon == month_of_year and tm.tm_mday == day_of_month:
+            pieces.append(self.buf[self.pos:])
+            self.pos = len(self.buf)
+            if self.eof:
                 break
-            offset += 1
-        else:
-            raise ValueError('date "%s" is invalid' % date_str)
-    elif not m5 is None:
-        # may raise ValueError
-        tm = time.strptime(date_str, '%b %d, %Y')
-    else:
-        raise ValueError('date "%s" could not be interpreted' % date_str)
-    return '%d-%02d-%02d' % (tm.tm_year, tm.tm_mon, tm.tm_mday)
-
-parser = argparse.ArgumentParser(description = 'Download a set of answers from Quora')
-parser.add_argument('input_file', help='file containing JSON-encoded list of timestamped URLs to download')
-parser.add_argument('output_dir', nargs='?', default='./quora-answers', help='where to store the downloaded answers and images')
-parser.add_argument('-d', '--delay', default=0, type=float, help='Time to sleep between answers, in seconds')
-parser.add_argument('-t', '--origin_timestamp', default=None, type=int, help='JS time when the list of URLs was fetched')
-parser.add_argument('-z', '--origin_timezone', default=None, type=int, help='browser timezone')
-parser.add_argument('-v', '--verbose', action='store_true', help='enable debug messages')
-parser.add_argument('-o', '--overwrite', action='store_true', help='Overwrite existing answers')
-
-global args
-args = parser.parse_args()
-
-# Determine the origin for relative date computation
-if args.origin_timestamp is None:
-    log_if_v('Using current time')
-    args.origin_timestamp = time.time()
-else:
-    args.origin_timestamp //= 1000
-if args.origin_timezone is None:
-    log_if_v('Using system time zone')
-    args.origin_timezone = time.timezone
-else:
-    args.origin_timezone *= 60
-origin = args.origin_timestamp - args.origin_timezone
-
-# Load the list of answer URLs from the input file.
-log_if_v('Loading input file %s' % args.input_file)
-with open(args.input_file, 'rb') as input_file:
-    answers = json.load(input_file)
-print('Found %d answers' % len(answers), file=sys.stderr)
-
-# Check the validity of the input
-if type(answers) != list:
-    sys.exit('[FATAL] Incorrect input format')
-for e in answers:
-    if type(e) != list or len(e) != 2 or type(e[0]) != str or type(e[1]) != str:
-        sys.exit('[FATAL] Incorrect input format')
-
-log_if_v('Creating directory %s' % args.output_dir)
-try:
-    os.mkdir(args.output_dir, 0o700)
-except OSError as error:
-    if error.errno == errno.EEXIST:
-        log_if_v('Directory already exists')
-    else:
-        # This is the top level, and we have nothing else to do if we failed
-        raise
-os.chdir(args.output_dir)
-download_file_count = 0
-for e in answers:
-    sys.stderr.flush()
-    url = e[0]
-    print('URL: %s' % url, file=sys.stderr)
+            self.read_more()
+        return ''.join(pieces)
+
+    def __iter__(self):
+        # Both formats start with '[', but in a list of answers it is followed by
+        # another '[' (or the end of the list), and in a single answer by the URL.
+        if self.skip_whitespace() == '[' and self.peek(1)[0] in ('[', ']', ''):
+            return self.read_list()
+        return self.read_lines()
+
+    def read_list(self):
+        self.pos += 1
+        c = self.skip_whitespace()
+        while c != ']':
+            if c == '':
+                raise ValueError('unexpected end of input')
+            yield self.decode()
+            c = self.skip_whitespace()
+            if c == ',':
+                self.pos += 1
+                c = self.skip_whitespace()
+            elif c != ']':
+                raise ValueError('expected "," or "]" in list of answers')
+
+    # Each line is decoded on its own, so that a malformed line doesn't make us
+    # read on to the end of the input looking for the rest of its value.
+    def read_lines(self):
+        while self.skip_whitespace() != '':
+            try:
+                value = json.loads(self.read_line())
+            except ValueError:
+                value = None
+            yield value
+
+# Records what happened to each URL: whether its answer has been saved ('done') or
+# couldn't be downloaded ('failed'), how many times we have tried to download it
+# and the last HTTP status we got. For saved answers, it also keeps the validators
+# needed to check whether the answer has changed since: the ETag and Last-Modified
+# headers sent with the page, and the SHA-256 hash of its content. The journal
+# file is a JsonLinesLog, so a crash loses at most the change being written. Safe
+# to share between threads. pipeline.py also records the converter settings that each
+# answer was converted with, the images it refers to, as (URL, local filename)
+# pairs, and those of them that couldn't be saved.
+class CrawlJournal:
+    def __init__(self, path):
+        self.log = JsonLinesLog(path, 'url')
+        if self.log.malformed > 0:
+            log_if_v('Ignored %d malformed journal lines' % self.log.malformed)
+        self.entries = self.log.entries
+        self.failed = set()
+        self.lock = threading.Lock()
+
+    def state(self, url):
+        entry = self.entries.get(url)
+        return None if entry is None else entry['state']
+
+    # Returns the validators recorded for the answer at `url`, if it was saved as
+    # `filename`, or an empty dict.
+    def validators(self, url, filename):
+        entry = self.entries.get(url)
+        if entry is None or entry['filename'] != filename:
+            return {}
+        return entry.get('validators', {})
+
+    # Returns the converter settings recorded for the answer at `url`, if any.
+    def settings(self, url):
+        entry = self.entries.get(url)
+        return None if entry is None else entry.get('settings')
+
+    # Returns the images recorded for the answer at `url`, and those of them
+    # that couldn't be saved.
+    def images(self, url):
+        entry = self.entries.get(url)
+        return [] if entry is None else [tuple(image) for image in entry.get('images', [])]
+
+    def failed_images(self, url):
+        entry = self.entries.get(url)
+        return set() if entry is None else {tuple(image) for image in entry.get('failed_images', [])}
+
+    # Records the outcome of `attempts` more attempts to download `url`. Unless
+    # new `validators`, `settings` and `images` are given, the ones recorded
+    # before are kept; `failed_images` goes with `images`.
+    def record(self, url, filename, state, attempts, status, validators=None, settings=None, images=None, failed_images=()):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                attempts += entry['attempts']
+                if entry['filename'] == filename:
+                    if validators is None:
+                        validators = entry.get('validators')
+                    if settings is None:
+                        settings = entry.get('settings')
+                    if images is None:
+                        images = entry.get('images')
+                        failed_images = entry.get('failed_images', ())
+            entry = {'url': url, 'filename': filename, 'state': state, 'attempts': attempts, 'status': status}
+            if validators:
+                entry['validators'] = validators
+            if settings:
+                entry['settings'] = settings
+            if images:
+                entry['images'] = images
+            if failed_images:
+                entry['failed_images'] = sorted(failed_images)
+            self.log.write(entry)
+            if state == 'failed':
+                self.failed.add(url)
+            else:
+                self.failed.discard(url)
+
+    def close(self):
+        self.log.close()
+
+def is_valid_answer(e):
+    return type(e) == list and len(e) == 2 and type(e[0]) == str and type(e[1]) == str
+
+# Yields only the well-formed answers, reporting the rest, for --stream mode.
+def check_answers(answers):
+    global input_count, invalid_count
+    try:
+        for e in answers:
+            input_count += 1
+            if not is_valid_answer(e):
+                print('[ERROR] Entry %d of the input is malformed; skipping' % input_count, file=sys.stderr)
+                invalid_count += 1
+                report.run_stats.fail('malformed_input')
+                continue
+            yield e
+    except ValueError as error:
+        print('[ERROR] Malformed input after entry %d (%s); ignoring the rest of the input' % (input_count, error), file=sys.stderr)
+        report.run_stats.fail('malformed_input')
+
+# Fetches the answer at `url`, retrying with exponential backoff when the failure
+# might be temporary: network errors, 429 Too Many Requests and 5xx server errors.
+# Returns the response (or None if the download failed) and the number of
+# attempts made.
+def fetch_answer(url, filename, stats, headers=None):
+    attempts = 0
+    while True:
+        attempts += 1
+        with stats.time('rate_limit'):
+            rate_limiter.wait()
+        try:
+            with stats.time('download'):
+                response = connection_pool.get(url, headers)
+            stats.count('bytes_downloaded', len(response.data))
+            return response, attempts
+        except urllib.error.HTTPError as error:
+            status = error.code
+            reason = error.reason
+            retry = status == 429 or status >= 500
+            retry_after = error.headers.get('Retry-After', '') if error.headers is not None else ''
+        except urllib.error.URLError as error:
+            status = None
+            reason = error.reason
+            retry = True
+            retry_after = ''
+        if not retry or attempts > args.retries:
+            print('[ERROR] Failed to download answer from URL %s (%s)' % (url, reason), file=sys.stderr)
+            journal.record(url, filename, 'failed', attempts, status)
+            stats.fail('network' if status is None else 'http_%d' % status)
+            return None, attempts
+        delay = args.backoff * 2 ** (attempts - 1)
+        # Don't come back sooner than the server asked us to
+        if retry_after.strip().isdigit():
+            delay = max(delay, int(retry_after))
+        print('[WARNING] Failed to download answer from URL %s (%s); retrying in %g seconds' % (url, reason, delay), file=sys.stderr)
+        stats.count('retries')
+        with stats.time('backoff'):
+            time.sleep(delay)
+
+# Returns the request headers that make the server send the page only if it has
+# changed since it was saved with the given validators.
+def conditional_headers(validators):
+    headers = {}
+    if 'etag' in validators:
+        headers['If-None-Match'] = validators['etag']
+    if 'last_modified' in validators:
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
 
+# Downloads a single [url, date string] entry from the input, unless it has already
+# been saved. Returns 'downloaded' if a download was attempted, 'unchanged' if an
+# answer was checked with --refresh and hasn't changed, and None otherwise.
+def process_answer(e):
+    stats = Stats()
+    try:
+        return save_answer(e, stats)
+    finally:
+        report.add_file(e[0], stats.as_dict())
+
+# Returns the name to save the answer of a [url, date string] entry under, made
+# of the date when the answer was written and the question part of the URL, or
+# None if the URL has no question part.
+def answer_filename(e):
+    url = e[0]
     # Determine the date when this answer was written
     try:
-        added_time = parse_quora_date(origin, e[1])
+        added_time = date_resolver.resolve(e[1])
     except ValueError as error:
         print('[WARNING] Failed to parse date: %s' % str(error), file=sys.stderr)
         added_time = 'xxxx-xx-xx'
@@ -142,7 +325,7 @@ for e in answers:
         filename += m2.group(1)
     else:
         print('[ERROR] Could not find question part of URL %s; skipping' % url, file=sys.stderr)
-        continue
+        return None
     # Trim the filename if it's too long. 255 bytes is the limit on many filesystems.
     total_byte_length = len(bytes(filename + '.html', encoding="utf-8"))
     filename_bytes = bytes(filename, encoding="utf-8")
@@ -158,24 +341,194 @@ for e in answers:
         log_if_v('Filename was truncated to at most 255 bytes.')
     filename += '.html'
     log_if_v('Filename: %s' % filename)
+    return filename
+
+# Returns the validators of a downloaded answer (see CrawlJournal).
+def response_validators(response, stats):
+    with stats.time('hash'):
+        validators = {'sha256': hashlib.sha256(response.data).hexdigest()}
+    if response.headers.get('ETag') is not None:
+        validators['etag'] = response.headers.get('ETag')
+    if response.headers.get('Last-Modified') is not None:
+        validators['last_modified'] = response.headers.get('Last-Modified')
+    return validators
+
+def save_answer(e, stats):
+    sys.stderr.flush()
+    url = e[0]
+    print('URL: %s' % url, file=sys.stderr)
+    filename = answer_filename(e)
+    if filename is None:
+        stats.fail('bad_url')
+        return None
+
+    # With --resume, trust the journal instead of looking for the file
+    if args.resume and journal.state(url) == 'done':
+        log_if_v('Answer was already downloaded according to the journal. Skipping')
+        stats.count('skipped')
+        return None
 
     # If overwrite is enabled or the answer doesn't exist
-    if args.overwrite or not os.path.isfile(filename):
-        # Fetch the URL to find the answer
+    exists = os.path.isfile(filename)
+    if args.overwrite or args.refresh or not exists:
+        # Fetch the URL to find the answer. With --refresh, only ask for it if it
+        # has changed since we saved it.
+        validators = journal.validators(url, filename) if exists else {}
+        headers = conditional_headers(validators) if args.refresh and not args.overwrite else None
         log_if_v('Downloading answer from URL %s' % url)
+        response, attempts = fetch_answer(url, filename, stats, headers)
+        if response is None:
+            return None
+        if response.status == 304:
+            log_if_v('Answer has not changed since it was saved. Skipping')
+            journal.record(url, filename, 'done', attempts, response.status)
+            stats.count('unchanged')
+            return 'unchanged'
+        new_validators = response_validators(response, stats)
+        # Don't touch the saved answer if it's the same, so that the converter
+        # knows it doesn't have to convert it again.
+        if exists and args.refresh and not args.overwrite:
+            try:
+                with stats.time('hash'):
+                    old_sha256 = validators.get('sha256') or file_sha256(filename)
+            except IOError:
+                old_sha256 = None
+            if old_sha256 == new_validators['sha256']:
+                log_if_v('Answer has not changed since it was saved. Skipping')
+                journal.record(url, filename, 'done', attempts, response.status, new_validators)
+                stats.count('unchanged')
+                return 'unchanged'
         try:
-            page_html = urllib.request.urlopen(url).read()
-            with open(filename, 'wb') as f:
-                f.write(page_html)
-        except urllib.error.URLError as error:
-            print('[ERROR] Failed to download answer from URL %s (%s)' % (url, error.reason), file=sys.stderr)
-            continue
+            with stats.time('save'):
+                write_file_atomically(filename, response.data)
         except IOError as error:
             print('[ERROR] Failed to save answer to file %s (%s)' % (filename, error.strerror), file=sys.stderr)
-
-        download_file_count += 1
-        time.sleep(args.delay)
+            journal.record(url, filename, 'failed', attempts, response.status)
+            stats.fail('save')
+            return 'downloaded'
+        journal.record(url, filename, 'done', attempts, response.status, new_validators)
+        stats.count('downloaded')
+        return 'downloaded'
     else:
         log_if_v('Answer File : %s Already Exists. Skipping' % filename)
+        if journal.state(url) != 'done':
+            journal.record(url, filename, 'done', 0, None)
+        stats.count('skipped')
+        return None
 
-print('Done. Downloaded %d files' % download_file_count, file=sys.stderr)
+# Returns the DateResolver for the dates in the input, which are relative to when
+# the list of answers was fetched (--origin_timestamp and --origin_timezone).
+def make_date_resolver(args):
+    # Determine the origin for relative date computation
+    if args.origin_timestamp is None:
+        log_if_v('Using current time')
+        args.origin_timestamp = time.time()
+    else:
+        args.origin_timestamp //= 1000
+    if args.origin_timezone is None:
+        log_if_v('Using system time zone')
+        args.origin_timezone = time.timezone
+    else:
+        args.origin_timezone *= 60
+    origin = args.origin_timestamp - args.origin_timezone
+    return DateResolver(origin)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Download a set of answers from Quora')
+    parser.add_argument('input_file', help='file containing JSON-encoded list of timestamped URLs to download, or one JSON-encoded URL and timestamp per line')
+    parser.add_argument('output_dir', nargs='?', default='./quora-answers', help='where to store the downloaded answers and images')
+    parser.add_argument('-d', '--delay', default=0, type=float, help='Minimum time between the start of two downloads, in seconds')
+    parser.add_argument('-t', '--origin_timestamp', default=None, type=int, help='JS time when the list of URLs was fetched')
+    parser.add_argument('-z', '--origin_timezone', default=None, type=int, help='browser timezone')
+    parser.add_argument('-v', '--verbose', action='store_true', help='enable debug messages')
+    parser.add_argument('-o', '--overwrite', action='store_true', help='Overwrite existing answers')
+    parser.add_argument('-R', '--refresh', action='store_true', help='Check whether existing answers have changed, and download only the ones that have')
+    parser.add_argument('-j', '--jobs', default=1, type=int, help='Number of answers to download concurrently')
+    parser.add_argument('-s', '--stream', action='store_true', help='Start downloading while still reading the input file, and skip malformed entries instead of stopping')
+    parser.add_argument('-r', '--retries', default=3, type=int, help='Number of times to retry a download that failed with a network error, 429 or 5xx status')
+    parser.add_argument('-b', '--backoff', default=1, type=float, help='Time to wait before the first retry, in seconds; doubled after each further failure')
+    parser.add_argument('--report', default=None, help='Write timings, byte counts and failure counts for the run, as JSON, to this file')
+    parser.add_argument('--profile', default=None, help='Save a cProfile profile of the run to this file (only the main thread is profiled, so use it with --jobs=1)')
+    parser.add_argument('--resume', action='store_true', help='Only download answers that the crawl journal does not record as downloaded, without checking the output directory')
+
+    global args
+    args = parser.parse_args()
+    report = RunReport('crawler')
+    # We are going to change into output_dir
+    if args.report is not None:
+        args.report = os.path.abspath(args.report)
+    if args.profile is not None:
+        args.profile = os.path.abspath(args.profile)
+
+    date_resolver = make_date_resolver(args)
+
+    # Load the list of answer URLs from the input file.
+    log_if_v('Loading input file %s' % args.input_file)
+    input_file = open(args.input_file, 'r', encoding='utf-8-sig')
+    input_count = 0
+    invalid_count = 0
+    if args.stream:
+        answers = check_answers(AnswerReader(input_file))
+    else:
+        try:
+            with report.run_stats.time('read_input'):
+                answers = list(AnswerReader(input_file))
+        except ValueError:
+            sys.exit('[FATAL] Incorrect input format')
+        input_file.close()
+        print('Found %d answers' % len(answers), file=sys.stderr)
+
+        # Check the validity of the input
+        for e in answers:
+            if not is_valid_answer(e):
+                sys.exit('[FATAL] Incorrect input format')
+
+    log_if_v('Creating directory %s' % args.output_dir)
+    try:
+        os.mkdir(args.output_dir, 0o700)
+    except OSError as error:
+        if error.errno == errno.EEXIST:
+            log_if_v('Directory already exists')
+        else:
+            # This is the top level, and we have nothing else to do if we failed
+            raise
+    os.chdir(args.output_dir)
+    journal = CrawlJournal(JOURNAL_NAME)
+    rate_limiter = RateLimiter(args.delay)
+    connection_pool = ConnectionPool()
+    results = collections.Counter()
+    with profiled(args.profile):
+        if args.jobs > 1:
+            sys.stderr = LineBufferedWriter(sys.stderr)
+            # Only keep a few answers queued at a time, so that in --stream mode we don't
+            # read the whole input before the first download finishes.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+                in_flight = set()
+                for e in answers:
+                    if len(in_flight) >= 2 * args.jobs:
+                        done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                        results.update(future.result() for future in done)
+                    in_flight.add(executor.submit(process_answer, e))
+                results.update(future.result() for future in concurrent.futures.as_completed(in_flight))
+        else:
+            for e in answers:
+                results[process_answer(e)] += 1
+
+    if args.stream:
+        input_file.close()
+        print('Read %d answers, skipped %d malformed ones' % (input_count, invalid_count), file=sys.stderr)
+    connection_pool.close()
+    journal.close()
+    print('Opened %d connections, reused them %d times' % (connection_pool.opened, connection_pool.reused), file=sys.stderr)
+    if journal.failed:
+        print('[ERROR] Failed to download %d answers; run again with --resume to retry them' % len(journal.failed), file=sys.stderr)
+    if args.refresh:
+        print('%d answers had not changed' % results['unchanged'], file=sys.stderr)
+    if args.report is not None:
+        report.run_stats.count('connections_opened', connection_pool.opened)
+        report.run_stats.count('connections_reused', connection_pool.reused)
+        try:
+            report.write(args.report, vars(args))
+        except IOError as error:
+            print('[ERROR] Failed to write report to %s (%s)' % (args.report, error.strerror), file=sys.stderr)
+    print('Done. Downloaded %d files' % results['downloaded'], file=sys.stderr)
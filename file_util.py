@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+import tempfile
+
+# Saves `data` under `path` by writing it to a temporary file and renaming that,
+# so that an interrupted write never leaves a truncated file behind. Each write
+# gets its own temporary file, so threads saving the same path at the same time
+# can't interfere; the last rename wins.
+def write_file_atomically(path, data):
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.part', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# A dict of JSON objects, keyed by their `key` field, that is kept in a file as one
+# object per line. Each change is appended as a line, and later lines override
+# earlier lines for the same key, so a crash loses at most the line being written.
+# Lines that can't be read (most likely one cut short by a crash) are skipped and
+# counted in `malformed`; the file is compacted when it is loaded, if it has more
+# lines than entries.
+class JsonLinesLog:
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.entries = {}
+        self.malformed = 0
+        line_count = 0
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line_count += 1
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry[key]] = entry
+                    except (ValueError, KeyError, TypeError):
+                        self.malformed += 1
+        except FileNotFoundError:
+            pass
+        if line_count > len(self.entries):
+            self.compact()
+        self.file = open(path, 'a', encoding='utf-8', buffering=1)
+
+    def compact(self):
+        write_file_atomically(self.path, ''.join(json.dumps(entry) + '\n' for entry in self.entries.values()).encode('utf-8'))
+
+    def write(self, entry):
+        self.entries[entry[self.key]] = entry
+        self.file.write(json.dumps(entry) + '\n')
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,173 @@
+import base64
+import gzip
+import http.client
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+
+# Identify ourselves the same way urllib.request.urlopen does, so that servers
+# keep treating us the same way.
+USER_AGENT = 'Python-urllib/%s' % urllib.request.__version__
+MAX_REDIRECTS = 10
+
+class Response:
+    def __init__(self, url, status, headers, data):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+# A minimal replacement for urllib.request.urlopen that keeps connections alive
+# and reuses them for later requests to the same host, so that we don't pay for
+# a new TCP (and TLS) handshake on every download. Also asks for gzip/deflate
+# compressed responses. Safe to share between threads; each connection is only
+# used by one thread at a time.
+# Like urlopen, it follows redirects, raises urllib.error.HTTPError for error
+# statuses (4xx and 5xx) and urllib.error.URLError if the request couldn't be
+# made at all, and goes through the proxies set in the environment (http_proxy,
+# https_proxy and no_proxy): plain HTTP requests are sent to the proxy, and HTTPS
+# requests are tunnelled through it with CONNECT.
+class ConnectionPool:
+    def __init__(self):
+        self.proxies = urllib.request.getproxies()
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def get(self, url, headers=None):
+        for _ in range(MAX_REDIRECTS + 1):
+            status, response_headers, data = self.request(url, headers)
+            location = response_headers.get('Location')
+            if status in (301, 302, 303, 307, 308) and location is not None:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if status >= 400:
+                raise urllib.error.HTTPError(url, status, http.client.responses.get(status, ''), response_headers, None)
+            return Response(url, status, response_headers, data)
+        raise urllib.error.URLError('too many redirects')
+
+    def request(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise urllib.error.URLError('unsupported URL %s' % url)
+        proxy = self.proxy_for(parts)
+        key = (parts.scheme, parts.hostname, parts.port, proxy)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request_headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip, deflate'}
+        if proxy is not None and parts.scheme == 'http':
+            # The proxy needs the whole URL to know where to send the request.
+            path = urllib.parse.urlunsplit(parts._replace(path=path, query='', fragment=''))
+            request_headers.update(proxy_auth_headers(proxy))
+        if headers:
+            request_headers.update(headers)
+        while True:
+            conn, reused = self.checkout(key)
+            try:
+                conn.request('GET', path, headers=request_headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as error:
+                conn.close()
+                # The server may have closed an idle connection just as we tried to reuse it.
+                # In that case, try again with a fresh one.
+                if reused:
+                    continue
+                raise urllib.error.URLError(error)
+            except (OSError, http.client.HTTPException) as error:
+                conn.close()
+                raise urllib.error.URLError(error)
+            break
+        if response.will_close:
+            conn.close()
+        else:
+            self.checkin(key, conn)
+        return response.status, response.headers, decode_body(response.headers.get('Content-Encoding'), data)
+
+    def checkout(self, key):
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                self.reused += 1
+                return connections.pop(), True
+            self.opened += 1
+        scheme, host, port, proxy = key
+        if proxy is None:
+            if scheme == 'https':
+                return http.client.HTTPSConnection(host, port), False
+            return http.client.HTTPConnection(host, port), False
+        proxy_parts = urllib.parse.urlsplit(proxy)
+        proxy_port = proxy_parts.port or (443 if proxy_parts.scheme == 'https' else 80)
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(proxy_parts.hostname, proxy_port)
+            conn.set_tunnel(host, port, headers=proxy_auth_headers(proxy))
+            return conn, False
+        return http.client.HTTPConnection(proxy_parts.hostname, proxy_port), False
+
+    # Returns the URL of the proxy to send a request for the URL split into
+    # `parts` through, or None to connect to the server directly.
+    def proxy_for(self, parts):
+        proxy = self.proxies.get(parts.scheme)
+        if proxy is None or urllib.request.proxy_bypass(parts.hostname):
+            return None
+        # Like urlopen, accept proxies given as just host:port.
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        return proxy
+
+    def checkin(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for conn in connections:
+                    conn.close()
+            self.idle = {}
+
+# Spaces out the start of downloads so that, across all threads sharing it, at
+# most one download begins every `interval` seconds.
+class RateLimiter:
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.interval <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        time.sleep(start - now)
+
+# Returns the headers that authenticate us to `proxy`, if its URL has a user name
+# and password.
+def proxy_auth_headers(proxy):
+    parts = urllib.parse.urlsplit(proxy)
+    if parts.username is None:
+        return {}
+    credentials = '%s:%s' % (urllib.parse.unquote(parts.username), urllib.parse.unquote(parts.password or ''))
+    return {'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')}
+
+def decode_body(encoding, data):
+    encoding = (encoding or '').strip().lower()
+    try:
+        if encoding in ('gzip', 'x-gzip'):
+            return gzip.decompress(data)
+        if encoding == 'deflate':
+            try:
+                return zlib.decompress(data)
+            except zlib.error:
+                # Some servers send a raw deflate stream without the zlib header.
+                return zlib.decompress(data, -zlib.MAX_WBITS)
+    except (OSError, EOFError, zlib.error) as error:
+        raise urllib.error.URLError('failed to decode %s response (%s)' % (encoding, error))
+    return data
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import converter
+import crawler
+import errno
+from file_util import write_file_atomically
+import gzip
+from http_pool import (ConnectionPool, RateLimiter)
+import multiprocessing
+import os
+import queue
+from run_report import (RunReport, Stats, profiled)
+from search_index import SearchIndex
+import sys
+import threading
+
+# Downloads answers and converts them in one go, without saving the raw pages in
+# between (unless asked to). The crawl stage downloads answers on a pool of
+# threads, like crawler.py, and hands the pages to the convert stage, which
+# converts them like converter.py, through a bounded queue. So the downloads
+# overlap with the conversions, and a run takes about as long as the slower of
+# the two stages, instead of as long as both together.
+
+def log_if_v(msg):
+    if args.verbose:
+        print('[DEBUG] %s' % msg, file=sys.stderr)
+
+# A page downloaded by the crawl stage, on its way to the convert stage, along
+# with what the crawl journal needs to know about it once it has been converted.
+class Page:
+    def __init__(self, url, filename, page_html, attempts, status, validators, stats):
+        self.url = url
+        self.filename = filename
+        self.page_html = page_html
+        self.attempts = attempts
+        self.status = status
+        self.validators = validators
+        self.stats = stats
+
+# Keeps a copy of a raw page in --raw_dir, in case it needs to be converted
+# again later, with converter.py.
+def save_raw_page(filename, page_html, stats):
+    path = args.raw_dir + '/' + filename
+    try:
+        with stats.time('save_raw'):
+            if args.compress_raw:
+                # Quicker than the default level, and nearly as small for HTML. No
+                # timestamp, so that the same page always compresses the same way.
+                write_file_atomically(path + '.gz', gzip.compress(page_html, compresslevel=6, mtime=0))
+            else:
+                write_file_atomically(path, page_html)
+    except OSError as error:
+        print('[WARNING] Failed to save raw page to file %s (%s)' % (path, error.strerror), file=sys.stderr)
+        stats.fail('save_raw')
+
+# The crawl stage for a single [url, date string] entry of the input: downloads the
+# answer, unless it has already been converted. Returns a Page, or None if there is
+# nothing to convert.
+def fetch_page(e, stats):
+    sys.stderr.flush()
+    url = e[0]
+    print('URL: %s' % url, file=sys.stderr)
+    filename = crawler.answer_filename(e)
+    if filename is None:
+        stats.fail('bad_url')
+        return None
+
+    # There is no raw page to look for, so trust the journal, like crawler.py
+    # --resume, as long as the answer was converted with the same settings, like
+    # converter.py's manifest. Otherwise it has to be downloaded again in full.
+    done = journal.state(url) == 'done' and output.has_answer(filename)
+    if done:
+        old_settings = journal.settings(url)
+        done = old_settings is not None and converter.same_settings(old_settings, settings)
+        if not done:
+            log_if_v('Answer was converted with different settings')
+    if done and not args.overwrite and not args.refresh:
+        log_if_v('Answer was already converted according to the journal. Skipping')
+        stats.count('skipped')
+        retry_failed_images(url, filename)
+        return None
+    validators = journal.validators(url, filename) if done else {}
+    headers = crawler.conditional_headers(validators) if args.refresh and not args.overwrite else None
+    log_if_v('Downloading answer from URL %s' % url)
+    response, attempts = crawler.fetch_answer(url, filename, stats, headers)
+    if response is None:
+        return None
+    if response.status == 304:
+        log_if_v('Answer has not changed since it was converted. Skipping')
+        journal.record(url, filename, 'done', attempts, response.status)
+        stats.count('unchanged')
+        retry_failed_images(url, filename)
+        return None
+    new_validators = crawler.response_validators(response, stats)
+    if args.refresh and not args.overwrite and validators.get('sha256') == new_validators['sha256']:
+        log_if_v('Answer has not changed since it was converted. Skipping')
+        journal.record(url, filename, 'done', attempts, response.status, new_validators)
+        stats.count('unchanged')
+        retry_failed_images(url, filename)
+        return None
+    if args.raw_dir is not None:
+        save_raw_page(filename, response.data, stats)
+    stats.count('downloaded')
+    return Page(url, filename, response.data, attempts, response.status, new_validators, stats)
+
+# For an answer that doesn't need to be converted again, but refers to images
+# that couldn't be saved last time, retries only those images, like converter.py.
+def retry_failed_images(url, filename):
+    failed_images = journal.failed_images(url)
+    if args.no_download or len(failed_images) == 0:
+        return
+    retried_answers.append((url, filename))
+    for src, image in failed_images:
+        # If the file exists, it was saved from another URL, and this one can't
+        # have it.
+        if not output.has_image(image):
+            log_if_v('Retrying image %s from answer %s' % (src, filename))
+            report.run_stats.count('images_retried')
+            downloader.add(src, image)
+
+# Puts `page` on the queue, waiting for room unless the convert stage has
+# stopped. Returns whether the page was put on the queue.
+def put_page(pages, page):
+    while not stopping.is_set():
+        try:
+            pages.put(page, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+# Runs the crawl stage on its own thread, putting each Page on the `pages` queue,
+# and None once all the answers have been downloaded. When the queue is full,
+# downloads wait for the convert stage to catch up, so that pages don't pile up
+# in memory. If the convert stage stops early, so does the crawl stage: answers
+# not yet downloaded are dropped, and so are pages waiting for the queue.
+def crawl(answers, pages):
+    def crawl_answer(e):
+        if stopping.is_set():
+            return
+        stats = Stats()
+        page = fetch_page(e, stats)
+        if page is None:
+            report.add_file(e[0], stats.as_dict())
+            return
+        with report.run_stats.time('wait_for_convert'):
+            put_page(pages, page)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+    try:
+        in_flight = set()
+        for e in answers:
+            if stopping.is_set():
+                break
+            if len(in_flight) >= 2 * args.jobs:
+                done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            in_flight.add(executor.submit(crawl_answer, e))
+        for future in concurrent.futures.as_completed(in_flight):
+            future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+        put_page(pages, None)
+
+# Takes a converted answer out of the pipeline: records it in the journal, or
+# queues its images for download first, like converter.py does.
+def finish_answer(page, images, stats):
+    # Don't hold on to the raw page while the images are downloaded.
+    page.page_html = None
+    report.add_file(page.url, page.stats.as_dict())
+    report.add_file(page.url, stats)
+    if images is None:
+        journal.record(page.url, page.filename, 'failed', page.attempts, page.status)
+        return
+    if args.no_download or len(images) == 0:
+        journal.record(page.url, page.filename, 'done', page.attempts, page.status, page.validators, settings, images)
+        return
+    answer_images[page.filename] = (page, images)
+    for src, image in images:
+        downloader.add(src, image)
+
+# Runs the convert stage, on pages taken from the queue until it yields None.
+def convert(pages):
+    if args.convert_jobs > 1:
+        # Fork would copy the crawl stage's threads' locks in whatever state they
+        # happen to be in, so start the workers afresh.
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.convert_jobs, mp_context=context, initializer=converter.init_worker, initargs=(args,)) as executor:
+            in_flight = {}
+            def finish_done(futures):
+                for future in futures:
+                    messages, images, stats = future.result()
+                    sys.stderr.write(messages)
+                    finish_answer(in_flight.pop(future), images, stats)
+            while True:
+                if len(in_flight) >= 2 * args.convert_jobs:
+                    done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    finish_done(done)
+                with report.run_stats.time('wait_for_crawl'):
+                    page = pages.get()
+                if page is None:
+                    break
+                in_flight[executor.submit(converter.convert_file_in_worker, page.filename, page.page_html)] = page
+            finish_done(concurrent.futures.as_completed(list(in_flight)))
+    else:
+        while True:
+            with report.run_stats.time('wait_for_crawl'):
+                page = pages.get()
+            if page is None:
+                break
+            stats = Stats()
+            images = converter.convert_file(page.filename, stats, page.page_html)
+            finish_answer(page, images, stats.as_dict())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Download a set of answers from Quora and convert them in one pass, without keeping the raw pages')
+    parser.add_argument('input_file', help='file containing JSON-encoded list of timestamped URLs to download, or one JSON-encoded URL and timestamp per line')
+    parser.add_argument('output_dir', nargs='?', default='./quora-answers-cooked', help='where to store the images and converted answers')
+    parser.add_argument('-d', '--delay', default=0, type=float, help='Minimum time between the start of two answer downloads, and separately of two image downloads, in seconds')
+    parser.add_argument('-t', '--origin_timestamp', default=None, type=int, help='JS time when the list of URLs was fetched')
+    parser.add_argument('-z', '--origin_timezone', default=None, type=int, help='browser timezone')
+    parser.add_argument('-v', '--verbose', action='store_true', help='be verbose')
+    parser.add_argument('-o', '--overwrite', action='store_true', help='Download and convert all answers, even those that have already been converted')
+    parser.add_argument('-R', '--refresh', action='store_true', help='Check whether answers that have already been converted have changed, and convert only the ones that have')
+    parser.add_argument('-j', '--jobs', default=4, type=int, help='Number of answers to download concurrently')
+    parser.add_argument('-r', '--retries', default=3, type=int, help='Number of times to retry a download that failed with a network error, 429 or 5xx status')
+    parser.add_argument('-b', '--backoff', default=1, type=float, help='Time to wait before the first retry, in seconds; doubled after each further failure')
+    parser.add_argument('-c', '--convert_jobs', default=1, type=int, help='Number of answers to convert in parallel, using separate processes')
+    parser.add_argument('-q', '--queue_size', default=16, type=int, help='Maximum number of downloaded answers waiting to be converted')
+    parser.add_argument('-n', '--no_download', action='store_true', help='Do not save images')
+    parser.add_argument('--download_jobs', default=4, type=int, help='Number of images to download concurrently')
+    parser.add_argument('--dedupe_images', action='store_true', help='Store each distinct image only once, and never download the same URL twice')
+    parser.add_argument('-e', '--engine', choices=['dom', 'stream'], default='dom', help='How to process the HTML (see converter.py)')
+    parser.add_argument('-a', '--archive', default=None, help='Save the converted answers and images into this SQLite database, instead of output_dir')
+    parser.add_argument('-i', '--index', default=None, help='Add the converted answers to the full-text search index in this SQLite database, for search.py')
+    parser.add_argument('--max_nodes', default=None, type=int, help='Skip answers with more than this many elements and pieces of text, instead of converting them')
+    parser.add_argument('--raw_dir', default=None, help='Also keep the raw pages in this directory, so that converter.py can convert them again later')
+    parser.add_argument('--compress_raw', action='store_true', help='Compress the raw pages kept in --raw_dir with gzip (converter.py reads them either way)')
+    parser.add_argument('--report', default=None, help='Write a JSON report of where the time went, per answer and in total, to this file')
+    parser.add_argument('--profile', default=None, help='Save a cProfile profile of the convert stage to this file (only the main thread is profiled, so use it with --convert_jobs=1)')
+
+    args = parser.parse_args()
+    report = RunReport('pipeline')
+    # The crawler's and the converter's functions find their settings in their
+    # own module's globals.
+    crawler.args = converter.args = args
+    crawler.report = report
+    crawler.date_resolver = crawler.make_date_resolver(args)
+    settings = converter.converter_settings()
+
+    # Load the list of answer URLs from the input file.
+    log_if_v('Loading input file %s' % args.input_file)
+    try:
+        with open(args.input_file, 'r', encoding='utf-8-sig') as input_file:
+            with report.run_stats.time('read_input'):
+                answers = list(crawler.AnswerReader(input_file))
+    except ValueError:
+        sys.exit('[FATAL] Incorrect input format')
+    for e in answers:
+        if not crawler.is_valid_answer(e):
+            sys.exit('[FATAL] Incorrect input format')
+    print('Found %d answers' % len(answers), file=sys.stderr)
+
+    if args.archive is None:
+        log_if_v('Creating directory %s' % args.output_dir)
+        try:
+            os.mkdir(args.output_dir, 0o700)
+        except OSError as error:
+            if error.errno == errno.EEXIST:
+                log_if_v('Directory already exists')
+            else:
+                # This is the top level, and we have nothing else to do if we failed
+                raise
+        journal_path = args.output_dir + '/' + crawler.JOURNAL_NAME
+    else:
+        log_if_v('Opening archive %s' % args.archive)
+        journal_path = args.archive + crawler.JOURNAL_NAME
+    if args.raw_dir is not None:
+        os.makedirs(args.raw_dir, 0o700, exist_ok=True)
+    output = converter.output = converter.open_output()
+    if args.index:
+        log_if_v('Opening search index %s' % args.index)
+        converter.search_index = SearchIndex(args.index)
+    journal = crawler.journal = crawler.CrawlJournal(journal_path)
+    crawler.rate_limiter = RateLimiter(args.delay)
+    crawler.connection_pool = ConnectionPool()
+    if not args.no_download:
+        store = converter.open_image_store()
+        downloader = converter.ImageDownloader(output, args.download_jobs, args.delay, report.run_stats, store)
+    answer_images = {}
+    # Answers that weren't converted again, but whose failed images were retried
+    retried_answers = []
+
+    # Both stages print as they go.
+    sys.stderr = crawler.LineBufferedWriter(sys.stderr)
+    pages = queue.Queue(maxsize=args.queue_size)
+    # Set when the convert stage stops, so that if it fails, the crawl stage
+    # doesn't wait forever for room on the full queue.
+    stopping = threading.Event()
+    crawl_thread = threading.Thread(target=crawl, args=(answers, pages))
+    crawl_thread.start()
+    try:
+        with profiled(args.profile):
+            convert(pages)
+    finally:
+        stopping.set()
+        crawl_thread.join()
+    crawler.connection_pool.close()
+
+    if not args.no_download:
+        log_if_v('Waiting for image downloads to finish')
+        with report.run_stats.time('image_wait'):
+            failed = downloader.wait()
+        if len(failed) > 0:
+            print('Failed to save %d images; pointing them back to Quora' % len(failed), file=sys.stderr)
+        for filename, (page, images) in answer_images.items():
+            failed_images = {image for image in images if image in failed}
+            # Recorded as done along with the images that failed, so that next
+            # time we only retry those.
+            if len(failed_images) == 0 or converter.restore_image_urls(filename, images, failed):
+                journal.record(page.url, filename, 'done', page.attempts, page.status, page.validators, settings, images, failed_images)
+            else:
+                journal.record(page.url, filename, 'failed', page.attempts, page.status)
+        for url, filename in retried_answers:
+            images = journal.images(url)
+            restored = journal.failed_images(url)
+            still_failed = {(src, image) for src, image in restored if downloader.saved.get(image) != src}
+            if still_failed != restored:
+                log_if_v('Pointing answer %s to the images saved this time' % filename)
+                if converter.restore_image_urls(filename, images, still_failed, restored):
+                    journal.record(url, filename, 'done', 0, journal.entries[url]['status'], images=images, failed_images=still_failed)
+        if store is not None and store is not output:
+            store.close()
+    journal.close()
+    output.close()
+    if args.index:
+        converter.search_index.close()
+
+    timings = report.run_stats.timings
+    print('The convert stage waited %.1f s for downloads; downloads waited %.1f s for the convert stage' % (timings['wait_for_crawl'], timings['wait_for_convert']), file=sys.stderr)
+    if journal.failed:
+        print('[ERROR] Failed to download or convert %d answers; run again to retry them' % len(journal.failed), file=sys.stderr)
+    image_failures = sum(1 for entry in journal.entries.values() if entry['state'] == 'done' and entry.get('failed_images'))
+    if image_failures > 0:
+        print('%d answers refer to images that could not be saved; run again to retry just those images' % image_failures, file=sys.stderr)
+    if args.report is not None:
+        try:
+            report.write(args.report, vars(args))
+        except IOError as error:
+            print('[ERROR] Failed to write report to %s (%s)' % (args.report, error.strerror), file=sys.stderr)
+    counts = report.totals()['counts']
+    print('Done. Downloaded %d answers and converted %d' % (counts.get('downloaded', 0), counts.get('converted', 0)), file=sys.stderr)
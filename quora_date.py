@@ -0,0 +1,100 @@
+import datetime
+import re
+import time
+
+DAYS_OF_WEEK = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+MONTHS_OF_YEAR = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+JUST_NOW_RE = re.compile(r'just now$')
+MINUTES_AGO_RE = re.compile(r'(\d+)m ago$')
+HOURS_AGO_RE = re.compile(r'(\d+)h ago$')
+DAY_OF_WEEK_RE = re.compile(r'(' + '|'.join(DAYS_OF_WEEK) + r')$')
+MONTH_DAY_RE = re.compile(r'(' + '|'.join(MONTHS_OF_YEAR) + r') (\d+)$')
+MONTH_DAY_YEAR_RE = re.compile(r'(' + '|'.join(MONTHS_OF_YEAR) + r') (\d+), (\d+)$')
+TIME_OF_DAY_RE = re.compile(r'(\d+)[ap]m$')
+# The crawler saves each answer under a name starting with the date it was added
+FILENAME_DATE_RE = re.compile(r'(\d{4}-\d\d-\d\d) ')
+
+# Resolves Quora's short date strings, e.g. "Added 31 Jan", into strings such
+# as '2015-01-31', relative to a fixed origin (timestamp offset by time zone).
+# Quora's short date strings don't provide enough information to determine the
+# exact time, unless it was within the last day, so we won't bother to be any
+# more precise.
+class DateResolver:
+    def __init__(self, origin):
+        self.origin = origin
+        tm = time.gmtime(origin)
+        self.origin_date = datetime.date(tm.tm_year, tm.tm_mon, tm.tm_mday)
+
+    # Raises ValueError if the string can't be interpreted.
+    def resolve(self, quora_str):
+        _, _, date_str = quora_str.partition('Added ')
+        date_str = date_str.strip()
+        if date_str == '':
+            raise ValueError('"%s" does not appear to indicate when answer was added' % quora_str)
+        if JUST_NOW_RE.match(date_str) or TIME_OF_DAY_RE.match(date_str):
+            # Using origin for time in am / pm since the time of the day will be discarded anyway
+            return format_date(self.origin_date)
+        m = MINUTES_AGO_RE.match(date_str)
+        if m:
+            return format_tm(time.gmtime(self.origin - 60*int(m.group(1))))
+        m = HOURS_AGO_RE.match(date_str)
+        if m:
+            return format_tm(time.gmtime(self.origin - 3600*int(m.group(1))))
+        m = DAY_OF_WEEK_RE.match(date_str)
+        if m:
+            # The most recent such day of the week strictly before the origin
+            offset = (self.origin_date.weekday() - DAYS_OF_WEEK.index(m.group(1))) % 7 or 7
+            return format_date(self.origin_date - datetime.timedelta(days=offset))
+        m = MONTH_DAY_RE.match(date_str)
+        if m:
+            # The most recent such day strictly before the origin, within the last 366 days
+            month_of_year = MONTHS_OF_YEAR.index(m.group(1)) + 1
+            day_of_month = int(m.group(2))
+            for year in (self.origin_date.year, self.origin_date.year - 1):
+                try:
+                    date = datetime.date(year, month_of_year, day_of_month)
+                except (ValueError, OverflowError):
+                    continue
+                if 1 <= (self.origin_date - date).days <= 366:
+                    return format_date(date)
+            raise ValueError('date "%s" is invalid' % date_str)
+        m = MONTH_DAY_YEAR_RE.match(date_str)
+        if m:
+            # Accept the same forms as time.strptime(date_str, '%b %d, %Y') does
+            if len(m.group(2)) > 2 or len(m.group(3)) != 4:
+                raise ValueError('date "%s" is invalid' % date_str)
+            try:
+                date = datetime.date(int(m.group(3)), MONTHS_OF_YEAR.index(m.group(1)) + 1, int(m.group(2)))
+            except ValueError:
+                raise ValueError('date "%s" is invalid' % date_str)
+            return format_date(date)
+        raise ValueError('date "%s" could not be interpreted' % date_str)
+
+    # Resolves a whole list of date strings, using `default` for the ones that
+    # can't be interpreted.
+    def resolve_all(self, quora_strs, default=None):
+        results = []
+        for quora_str in quora_strs:
+            try:
+                results.append(self.resolve(quora_str))
+            except ValueError:
+                results.append(default)
+        return results
+
+def format_date(date):
+    return '%d-%02d-%02d' % (date.year, date.month, date.day)
+
+def format_tm(tm):
+    return '%d-%02d-%02d' % (tm.tm_year, tm.tm_mon, tm.tm_mday)
+
+# Given origin (timestamp offset by time zone) and string from Quora, e.g.
+# "Added 31 Jan", returns a string such as '2015-01-31'.
+def parse_quora_date(origin, quora_str):
+    return DateResolver(origin).resolve(quora_str)
+
+# Returns the date in the name the crawler saved an answer under, or None if the
+# date couldn't be determined when it was saved.
+def filename_date(filename):
+    m = FILENAME_DATE_RE.match(filename)
+    return None if m is None else m.group(1)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import argparse
+import html
+import http.server
+import sqlite3
+import sys
+import urllib.parse
+import zlib
+
+# Reads answers and images out of an archive written by `converter.py --archive`,
+# one at a time, without unpacking the rest of it.
+class Archive:
+    def __init__(self, path):
+        # Open read-only, so that a mistyped path doesn't create an empty archive.
+        self.db = sqlite3.connect('file:%s?mode=ro' % urllib.parse.quote(path), uri=True)
+
+    # Returns (filename, title, date) for each answer, oldest first.
+    def answers(self):
+        return self.db.execute('SELECT filename, title, date FROM answers ORDER BY date, filename').fetchall()
+
+    # Returns the converted HTML of an answer, or None if there is no such answer.
+    def answer(self, filename):
+        row = self.db.execute('SELECT html FROM answers WHERE filename = ?', (filename,)).fetchone()
+        return None if row is None else zlib.decompress(row[0])
+
+    # Returns the content of an image, or None if there is no such image.
+    def image(self, filename):
+        row = self.db.execute('SELECT data FROM images JOIN blobs USING (sha256) WHERE filename = ?', (filename,)).fetchone()
+        return None if row is None else row[0]
+
+def index_page(archive):
+    items = ['<li>%s <a href="%s">%s</a></li>' % (html.escape(date or 'xxxx-xx-xx'), urllib.parse.quote(filename), html.escape(title or filename))
+             for filename, title, date in archive.answers()]
+    return ('<!DOCTYPE html><html><head><meta charset=utf-8><title>Answers</title></head><body><ul>%s</ul></body></html>' % ''.join(items)).encode('utf-8')
+
+class ArchiveRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        filename = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path.lstrip('/'))
+        if filename == '':
+            self.send(index_page(self.server.archive), 'text/html; charset=utf-8')
+            return
+        data = self.server.archive.answer(filename)
+        if data is not None:
+            self.send(data, 'text/html; charset=utf-8')
+            return
+        data = self.server.archive.image(filename)
+        if data is not None:
+            self.send(data, 'image/png')
+            return
+        self.send_error(404)
+
+    def send(self, data, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Read answers from an archive written by converter.py --archive')
+    parser.add_argument('archive', help='the archive to read')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    subparsers.add_parser('list', help='list the answers in the archive')
+    cat_parser = subparsers.add_parser('cat', help='write the HTML of an answer (or the content of an image) to standard output')
+    cat_parser.add_argument('filename', help='filename of the answer or image')
+    serve_parser = subparsers.add_parser('serve', help='serve the answers and their images over HTTP')
+    serve_parser.add_argument('-p', '--port', default=8000, type=int, help='port to listen on')
+    serve_parser.add_argument('-b', '--bind', default='127.0.0.1', help='address to listen on')
+
+    args = parser.parse_args()
+    try:
+        archive = Archive(args.archive)
+        if args.command == 'list':
+            for filename, title, date in archive.answers():
+                print('%s\t%s' % (filename, title))
+        elif args.command == 'cat':
+            data = archive.answer(args.filename)
+            if data is None:
+                data = archive.image(args.filename)
+            if data is None:
+                sys.exit('[FATAL] No answer or image named %s in the archive' % args.filename)
+            sys.stdout.buffer.write(data)
+        else:
+            server = http.server.HTTPServer((args.bind, args.port), ArchiveRequestHandler)
+            server.archive = archive
+            print('Serving answers at http://%s:%d/' % (args.bind, args.port), file=sys.stderr)
+            server.serve_forever()
+    except sqlite3.Error as error:
+        sys.exit('[FATAL] Failed to read archive %s (%s)' % (args.archive, error))
@@ -0,0 +1,102 @@
+import collections
+import contextlib
+import cProfile
+import json
+import threading
+import time
+
+# Where the time went while processing one answer (or the run as a whole), in
+# seconds per stage, along with counts of things like bytes downloaded, and
+# counts of failures by type. Safe to share between threads.
+class Stats:
+    def __init__(self):
+        self.timings = collections.Counter()
+        self.counts = collections.Counter()
+        self.failures = collections.Counter()
+        self.lock = threading.Lock()
+
+    # Times the code in a with block as part of the given stage.
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.timings[stage] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def fail(self, kind):
+        with self.lock:
+            self.failures[kind] += 1
+
+    # A plain dict, which can be passed between processes and saved as JSON
+    def as_dict(self):
+        with self.lock:
+            return {'timings': dict(self.timings), 'counts': dict(self.counts), 'failures': dict(self.failures)}
+
+    def add_dict(self, stats):
+        with self.lock:
+            self.timings.update(stats['timings'])
+            self.counts.update(stats['counts'])
+            self.failures.update(stats['failures'])
+
+# Collects the Stats of each answer processed in a run, and of the parts of the
+# run that don't belong to any answer (such as image downloads), and writes them
+# out as JSON, along with their totals.
+class RunReport:
+    def __init__(self, script):
+        self.script = script
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.run_stats = Stats()
+        self.file_stats = {}
+        self.lock = threading.Lock()
+
+    # Adds the stats (as returned by Stats.as_dict) of one answer.
+    def add_file(self, filename, stats):
+        with self.lock:
+            self.file_stats.setdefault(filename, Stats()).add_dict(stats)
+
+    def totals(self):
+        totals = Stats()
+        totals.add_dict(self.run_stats.as_dict())
+        with self.lock:
+            for stats in self.file_stats.values():
+                totals.add_dict(stats.as_dict())
+        return totals.as_dict()
+
+    def write(self, path, settings):
+        report = {
+            'script': self.script,
+            'settings': settings,
+            'started': self.started,
+            'elapsed': time.perf_counter() - self.start,
+            'files': len(self.file_stats),
+            'totals': self.totals(),
+            'per_file': {filename: stats.as_dict() for filename, stats in sorted(self.file_stats.items())},
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+# Profiles the code in a with block, and saves the profile to `path`, in the
+# format pstats and tools like snakeviz read. Does nothing if `path` is None.
+# Only the calling thread is profiled.
+@contextlib.contextmanager
+def profiled(path):
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
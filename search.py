@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+import argparse
+from search_index import (SearchIndex, words_query)
+import sqlite3
+import sys
+import time
+
+parser = argparse.ArgumentParser(description = 'Search the answers indexed by converter.py --index')
+parser.add_argument('index', help='the search index to use')
+parser.add_argument('words', nargs='+', help='words to search for; only answers containing all of them are shown')
+parser.add_argument('-n', '--limit', default=20, type=int, help='maximum number of answers to show')
+parser.add_argument('-q', '--query', action='store_true', help='treat the words as an SQLite FTS5 query, e.g. \'title:python OR "hash table"\'')
+
+args = parser.parse_args()
+query = ' '.join(args.words) if args.query else words_query(args.words)
+try:
+    start = time.perf_counter()
+    search_index = SearchIndex(args.index, readonly=True)
+    hits = search_index.search(query, args.limit)
+    elapsed = time.perf_counter() - start
+except sqlite3.Error as error:
+    sys.exit('[FATAL] Search failed (%s)' % error)
+
+for filename, title, date, snippet in hits:
+    print('%s  %s' % (date or 'xxxx-xx-xx', title or '(no title)'))
+    print('    %s' % filename)
+    print('    %s' % snippet)
+print('%d answers found in %.1f ms' % (len(hits), elapsed * 1000), file=sys.stderr)
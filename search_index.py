@@ -0,0 +1,60 @@
+import sqlite3
+import urllib.parse
+from quora_date import filename_date
+
+# The title and body text are searchable; the filename and date are just stored
+# alongside them. remove_diacritics lets "naive" match "naïve". FTS5 can't look
+# up its UNINDEXED columns without scanning the whole table, so `docs` gives each
+# filename the rowid of its entry in `answers`.
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS answers USING fts5(
+    filename UNINDEXED, title, date UNINDEXED, body,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS docs (filename TEXT PRIMARY KEY);
+"""
+
+# How much more a match in the title counts than a match in the body
+TITLE_WEIGHT = 10.0
+
+# A full-text index of converted answers, in an SQLite database using FTS5.
+# Reconverting an answer replaces its entry, so the index can be kept up to date
+# incrementally. Like the converter's archive, each process opens its own
+# connection and SQLite takes care of locking between them.
+class SearchIndex:
+    def __init__(self, path, readonly=False):
+        if readonly:
+            # Don't create an empty index if the path is mistyped.
+            self.db = sqlite3.connect('file:%s?mode=ro' % urllib.parse.quote(path), uri=True)
+        else:
+            self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.executescript(SCHEMA)
+            with self.db:
+                self.db.execute('BEGIN IMMEDIATE')
+                # Indexes made before there was a `docs` table
+                if self.db.execute('SELECT 1 FROM docs LIMIT 1').fetchone() is None:
+                    self.db.execute('INSERT INTO docs (rowid, filename) SELECT rowid, filename FROM answers')
+
+    def add(self, filename, title, body):
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.execute('INSERT OR IGNORE INTO docs (filename) VALUES (?)', (filename,))
+            rowid = self.db.execute('SELECT rowid FROM docs WHERE filename = ?', (filename,)).fetchone()[0]
+            self.db.execute('DELETE FROM answers WHERE rowid = ?', (rowid,))
+            self.db.execute('INSERT INTO answers (rowid, filename, title, date, body) VALUES (?, ?, ?, ?, ?)', (rowid, filename, title, filename_date(filename), body))
+
+    # Returns (filename, title, date, snippet) for the best `limit` matches of an
+    # FTS5 query, best first. In the snippets, matches are marked with [brackets].
+    def search(self, query, limit):
+        return self.db.execute('SELECT filename, title, date, snippet(answers, 3, \'[\', \']\', \'...\', 16) FROM answers '
+                               'WHERE answers MATCH ? ORDER BY bm25(answers, 0, ?, 0, 1) LIMIT ?',
+                               (query, TITLE_WEIGHT, limit)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+# Turns words typed by a user into an FTS5 query that matches answers containing
+# all of them, so that characters like '+' or '-' don't need escaping.
+def words_query(words):
+    return ' '.join('"%s"' % word.replace('"', '""') for word in words)
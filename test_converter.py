@@ -0,0 +1,161 @@
+import argparse
+import contextlib
+import io
+import os
+import re
+import sys
+import tempfile
+import unittest
+
+import converter
+from run_report import Stats
+
+# Well past the recursion limit, which is what the recursive cleanup used to hit
+DEEP_ANSWER_DEPTH = max(10000, 2 * sys.getrecursionlimit())
+LARGE_ANSWER_NODES = 100000
+
+def make_page(answer_html):
+    return ('<html><head><title>Test</title></head><body><div class="ExpandedAnswer">%s</div><p>after</p></body></html>' % answer_html).encode('utf-8')
+
+# An answer nested `depth` elements deep, mostly <span>s (which html5lib parses
+# quickly however deep they are), with some other elements, links and images
+# along the way, and an element the converter doesn't recognize near the bottom.
+def make_deep_page(depth):
+    tags = []
+    for i in range(depth):
+        if i == depth - 10:
+            tags.append('section')
+        elif i % 500 == 0:
+            tags.append(['div', 'blockquote', 'ul', 'li'][i // 500 % 4])
+        else:
+            tags.append('span')
+    pieces = []
+    for i, tag in enumerate(tags):
+        pieces.append('<%s class="level%d">text %d ' % (tag, i, i))
+        if i % 100 == 1:
+            pieces.append('<a href="/User-%d">link</a><img src="https://qph.example.com/main-%d.png">' % (i, i))
+    pieces.extend('</%s>' % tag for tag in reversed(tags))
+    return make_page(''.join(pieces))
+
+# An answer with about `node_count` elements and pieces of text, side by side.
+def make_large_page(node_count):
+    paragraph = '<p>Some <b>bold</b> text, <a href="/User">a link</a> and <code>code</code></p>'
+    return make_page(paragraph * (node_count // 9))
+
+class ConverterTest(unittest.TestCase):
+    def setUp(self):
+        converter.args = argparse.Namespace(verbose=False, no_download=False, dedupe_images=False, index=None, max_nodes=None)
+
+    # Converts the page with both engines, checks that they agree, and returns
+    # the converted answer and the number of nodes in it.
+    def convert_both(self, page_html):
+        results = []
+        for convert_page in (converter.convert_page_dom, converter.convert_page_stream):
+            stats = Stats()
+            with contextlib.redirect_stderr(io.StringIO()):
+                converted = convert_page(page_html, 'test.html', stats)
+            self.assertIsNotNone(converted, convert_page.__name__)
+            results.append((converted, stats.counts['answer_nodes']))
+        (dom, dom_nodes), (stream, stream_nodes) = results
+        self.assertEqual(dom.page_html, stream.page_html)
+        self.assertEqual(dom.images, stream.images)
+        self.assertEqual(dom.title, stream.title)
+        self.assertEqual(dom.text, stream.text)
+        self.assertEqual(dom_nodes, stream_nodes)
+        return dom, dom_nodes
+
+    # Checks that both engines give up on the page when it has one node more
+    # than --max_nodes allows, and convert it when it has exactly that many.
+    def check_max_nodes(self, page_html, node_count):
+        for convert_page in (converter.convert_page_dom, converter.convert_page_stream):
+            converter.args.max_nodes = node_count - 1
+            with contextlib.redirect_stderr(io.StringIO()):
+                self.assertRaises(converter.TooManyNodes, convert_page, page_html, 'test.html', Stats())
+            converter.args.max_nodes = node_count
+            with contextlib.redirect_stderr(io.StringIO()):
+                self.assertIsNotNone(convert_page(page_html, 'test.html', Stats()))
+
+    def test_deep_answer(self):
+        page_html = make_deep_page(DEEP_ANSWER_DEPTH)
+        converted, node_count = self.convert_both(page_html)
+        # Each level has an element and a piece of text.
+        self.assertGreaterEqual(node_count, 2 * DEEP_ANSWER_DEPTH)
+        self.assertTrue(b'text %d' % (DEEP_ANSWER_DEPTH - 1) in converted.page_html)
+        self.assertIn(('https://qph.example.com/main-1.png', 'main-1.png'), converted.images)
+        self.check_max_nodes(page_html, node_count)
+
+    def test_index_text(self):
+        converter.args.index = 'index.db'
+        page_html = make_page('<p>A caf&eacute; near AT&amp;T</p><p>two<br>lines, <b>bold</b>text</p>')
+        converted, _ = self.convert_both(page_html)
+        self.assertEqual(converted.text, 'A caf\u00e9 near AT&T two lines, bold text')
+
+    # Two URLs map to img.png and only the first of them can be downloaded on the
+    # first run; the image from a third URL only on the second run.
+    def test_restore_image_urls(self):
+        src_a = 'https://qph.example.com/a/img.png'
+        src_b = 'https://qph.example.com/b/img.png'
+        src_c = 'https://qph.example.com/c/other.png'
+        page_html = make_page('<p><img src="%s"><img src="%s"><img src="%s"></p>' % (src_a, src_b, src_c))
+        with tempfile.TemporaryDirectory() as output_dir:
+            converter.output = converter.OutputDirectory(output_dir)
+            converted = converter.convert_page_dom(page_html, 'test.html', Stats())
+            images = converted.images
+            self.assertEqual(images, [(src_a, 'img.png'), (src_b, 'img.png'), (src_c, 'other.png')])
+            converter.output.save_answer('test.html', converted.page_html)
+
+            def img_srcs():
+                return re.findall(rb'<img src="?([^" >]+)', converter.output.load_answer('test.html'))
+
+            def download_images(working):
+                downloader = converter.ImageDownloader(converter.output, 1, 0, Stats())
+                def download_one(src, filename):
+                    if src not in working:
+                        return False
+                    converter.output.save_image(filename, src.encode('utf-8'))
+                    return True
+                downloader.download_one = download_one
+                for src, image in images:
+                    downloader.add(src, image)
+                return downloader.wait(), downloader
+
+            # img.png falls back to the second URL when the first one fails.
+            failed, downloader = download_images({src_b})
+            self.assertEqual(failed, {(src_a, 'img.png'), (src_c, 'other.png')})
+            self.assertEqual(downloader.saved, {'img.png': src_b})
+            with open(os.path.join(output_dir, 'img.png'), 'rb') as f:
+                self.assertEqual(f.read(), src_b.encode('utf-8'))
+            self.assertTrue(converter.restore_image_urls('test.html', images, failed))
+            self.assertEqual(img_srcs(), [src_a.encode(), b'img.png', src_c.encode()])
+
+            # On the next run, only the images that failed are retried, as
+            # converter.py does, and those saved are pointed to their files again.
+            restored = failed
+            downloader = converter.ImageDownloader(converter.output, 1, 0, Stats())
+            downloader.download_one = lambda src, filename: src == src_c
+            for src, image in restored:
+                if not converter.output.has_image(image):
+                    downloader.add(src, image)
+            downloader.wait()
+            still_failed = {(src, image) for src, image in restored if downloader.saved.get(image) != src}
+            self.assertEqual(still_failed, {(src_a, 'img.png')})
+            self.assertTrue(converter.restore_image_urls('test.html', images, still_failed, restored))
+            self.assertEqual(img_srcs(), [src_a.encode(), b'img.png', b'other.png'])
+
+    def check_large_answer(self, node_count):
+        page_html = make_large_page(node_count)
+        converted, answer_nodes = self.convert_both(page_html)
+        self.assertGreaterEqual(answer_nodes, node_count - 9)
+        self.assertTrue(b'<a href="http://quora.com/User">' in converted.page_html)
+        self.check_max_nodes(page_html, answer_nodes)
+
+    def test_large_answer(self):
+        self.check_large_answer(LARGE_ANSWER_NODES)
+
+    # Takes a few minutes and about a gigabyte of memory
+    @unittest.skipUnless(os.environ.get('SLOW_TESTS'), 'set SLOW_TESTS=1 to convert an answer with a million nodes')
+    def test_million_node_answer(self):
+        self.check_large_answer(1000000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import io
+import json
+import unittest
+
+import crawler
+
+ANSWERS = [
+    ['https://www.quora.com/What-is-a-hash-table/answer/Some-User', 'Added 31 Jan'],
+    ['https://www.quora.com/Why-[brackets]-and-\\-escapes/answer/Some-User', 'Added Mon'],
+    ['https://www.quora.com/Caf%C3%A9/answer/Some-User', 'Added Jan 31, 2014'],
+]
+
+# Small enough that values, and the whitespace between them, are split across
+# reads in every possible place.
+CHUNK_SIZES = list(range(1, 10)) + [crawler.INPUT_CHUNK_SIZE]
+
+class AnswerReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.chunk_size = crawler.INPUT_CHUNK_SIZE
+
+    def tearDown(self):
+        crawler.INPUT_CHUNK_SIZE = self.chunk_size
+
+    # Checks that the input is read as `expected` whatever the chunk size.
+    def check_read(self, text, expected):
+        for chunk_size in CHUNK_SIZES:
+            crawler.INPUT_CHUNK_SIZE = chunk_size
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(list(crawler.AnswerReader(io.StringIO(text))), expected)
+
+    def test_compact_list(self):
+        self.check_read(json.dumps(ANSWERS, separators=(',', ':')), ANSWERS)
+
+    def test_indented_list(self):
+        self.check_read(json.dumps(ANSWERS, indent=4) + '\n', ANSWERS)
+
+    def test_json_lines(self):
+        lines = [json.dumps(e) for e in ANSWERS]
+        self.check_read('\n' + lines[0] + '\n\n  \n' + lines[1] + '\r\n' + lines[2], ANSWERS)
+
+    def test_empty_list(self):
+        self.check_read('[]', [])
+        self.check_read(' [ ] \n', [])
+
+    def test_malformed_line(self):
+        lines = [json.dumps(ANSWERS[0]), '["https://www.quora.com/Cut-short', json.dumps(ANSWERS[1])]
+        self.check_read('\n'.join(lines) + '\n', [ANSWERS[0], None, ANSWERS[1]])
+
+    def test_missing_comma(self):
+        text = '[%s %s]' % (json.dumps(ANSWERS[0]), json.dumps(ANSWERS[1]))
+        for chunk_size in CHUNK_SIZES:
+            crawler.INPUT_CHUNK_SIZE = chunk_size
+            with self.subTest(chunk_size=chunk_size):
+                answers = iter(crawler.AnswerReader(io.StringIO(text)))
+                self.assertEqual(next(answers), ANSWERS[0])
+                with self.assertRaisesRegex(ValueError, 'expected "," or "]"'):
+                    next(answers)
+
+if __name__ == '__main__':
+    unittest.main()
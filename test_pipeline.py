@@ -0,0 +1,66 @@
+import http.server
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+PIPELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline.py')
+ANSWER_COUNT = 20
+
+# Serves the same answer page at every path.
+class AnswerServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, page_html):
+        super().__init__(('127.0.0.1', 0), AnswerRequestHandler)
+        self.page_html = page_html
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+class AnswerRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.page_html)))
+        self.end_headers()
+        self.wfile.write(self.server.page_html)
+
+    def log_message(self, format, *args):
+        pass
+
+class PipelineTest(unittest.TestCase):
+    # Runs pipeline.py on ANSWER_COUNT answers, all served as `page_html`, and
+    # returns the finished process.
+    def run_pipeline(self, page_html, *extra_args):
+        server = AnswerServer(page_html)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        with tempfile.TemporaryDirectory() as work_dir:
+            answers_file = os.path.join(work_dir, 'answers.json')
+            base_url = 'http://127.0.0.1:%d' % server.server_address[1]
+            with open(answers_file, 'w', encoding='utf-8') as f:
+                json.dump([[base_url + '/quora.com/Question-%d/answer/User' % n, 'Added Jan 31, 2014'] for n in range(ANSWER_COUNT)], f)
+            argv = [sys.executable, PIPELINE, answers_file, os.path.join(work_dir, 'out'), '-t', '0', '-z', '0', '-n'] + list(extra_args)
+            return subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30)
+
+    def test_convert(self):
+        page_html = b'<html><head><title>Test</title></head><body><div class="ExpandedAnswer"><p>Answer</p></div></body></html>'
+        process = self.run_pipeline(page_html)
+        self.assertEqual(process.returncode, 0, process.stderr.decode())
+        self.assertIn(b'Downloaded %d answers and converted %d' % (ANSWER_COUNT, ANSWER_COUNT), process.stderr)
+
+    # cleanup_tree doesn't know what to do with comments, so converting this
+    # fails. The crawl stage has to stop rather than wait forever for room on the
+    # full queue.
+    def test_convert_fails(self):
+        page_html = b'<html><head><title>Test</title></head><body><div class="ExpandedAnswer"><!-- comment --></div></body></html>'
+        process = self.run_pipeline(page_html, '-j', '4', '-q', '1')
+        self.assertNotEqual(process.returncode, 0)
+        self.assertIn(b'ValueError', process.stderr)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import calendar
+import random
+import re
+import time
+import unittest
+
+from quora_date import (DateResolver, filename_date, parse_quora_date)
+
+# The original implementation, from before date parsing was moved into
+# quora_date. It walks backward one day at a time, which is slow but easy to get
+# right, so it serves as the reference that the new one must agree with.
+def old_parse_quora_date(origin, quora_str):
+    days_of_week = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+    months_of_year = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+    _, _, date_str = quora_str.partition('Added ')
+    date_str = date_str.strip()
+    if date_str == '':
+        raise ValueError('"%s" does not appear to indicate when answer was added' % quora_str)
+    m0 = re.match('just now$', date_str)
+    m1 = re.match(r'(\d+)m ago$', date_str)
+    m2 = re.match(r'(\d+)h ago$', date_str)
+    m3 = re.match('(' + '|'.join(days_of_week) + ')$', date_str)
+    m4 = re.match('(' + '|'.join(months_of_year) + r') (\d+)$', date_str)
+    m5 = re.match('(' + '|'.join(months_of_year) + r') (\d+), (\d+)$', date_str)
+    m6 = re.match(r'(\d+)[ap]m$', date_str)
+    if not m0 is None or not m6 is None:
+        tm = time.gmtime(origin)
+    elif not m1 is None:
+        tm = time.gmtime(origin - 60*int(m1.group(1)))
+    elif not m2 is None:
+        tm = time.gmtime(origin - 3600*int(m2.group(1)))
+    elif not m3 is None:
+        day_of_week = days_of_week.index(m3.group(1))
+        offset = 1
+        while offset <= 7:
+            tm = time.gmtime(origin - 86400*offset)
+            if tm.tm_wday == day_of_week:
+                break
+            offset += 1
+        else:
+            raise ValueError('date "%s" is invalid' % date_str)
+    elif not m4 is None:
+        month_of_year = months_of_year.index(m4.group(1)) + 1
+        day_of_month = int(m4.group(2))
+        offset = 1
+        while offset <= 366:
+            tm = time.gmtime(origin - 86400*offset)
+            if tm.tm_mon == month_of_year and tm.tm_mday == day_of_month:
+                break
+            offset += 1
+        else:
+            raise ValueError('date "%s" is invalid' % date_str)
+    elif not m5 is None:
+        tm = time.strptime(date_str, '%b %d, %Y')
+    else:
+        raise ValueError('date "%s" could not be interpreted' % date_str)
+    return '%d-%02d-%02d' % (tm.tm_year, tm.tm_mon, tm.tm_mday)
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+def origin_at(year, month, day, hour=12):
+    return calendar.timegm((year, month, day, hour, 0, 0))
+
+# Returns what parsing gives: the date string, or the type of exception raised.
+def outcome(parse, origin, quora_str):
+    try:
+        return parse(origin, quora_str)
+    except (ValueError, OverflowError) as error:
+        return type(error)
+
+class ParseQuoraDateTest(unittest.TestCase):
+    def assertMatchesOld(self, origin, quora_str):
+        self.assertEqual(outcome(parse_quora_date, origin, quora_str), outcome(old_parse_quora_date, origin, quora_str), 'origin %r, %r' % (origin, quora_str))
+
+    def assertAllMatchOld(self, origins, quora_strs):
+        for origin in origins:
+            for quora_str in quora_strs:
+                self.assertMatchesOld(origin, quora_str)
+
+    def test_examples(self):
+        origin = origin_at(2015, 3, 4)  # A Wednesday
+        self.assertEqual(parse_quora_date(origin, 'Added just now'), '2015-03-04')
+        self.assertEqual(parse_quora_date(origin, 'Added 3pm'), '2015-03-04')
+        self.assertEqual(parse_quora_date(origin, 'Added 13h ago'), '2015-03-03')
+        self.assertEqual(parse_quora_date(origin, 'Added Wed'), '2015-02-25')
+        self.assertEqual(parse_quora_date(origin, 'Added Tue'), '2015-03-03')
+        self.assertEqual(parse_quora_date(origin, 'Added Jan 31'), '2015-01-31')
+        self.assertEqual(parse_quora_date(origin, 'Added Mar 4'), '2014-03-04')
+        self.assertEqual(parse_quora_date(origin, 'Added Jan 5, 2012'), '2012-01-05')
+        for quora_str in ['', 'Added', 'Added ', 'Added yesterday', 'Added Jan', 'Written Jan 5']:
+            self.assertRaises(ValueError, parse_quora_date, origin, quora_str)
+
+    def test_relative_times(self):
+        origins = [origin_at(2016, 1, 1, 0), origin_at(2016, 3, 1, 0) + 59, origin_at(2016, 12, 31, 23)]
+        quora_strs = ['Added %dm ago' % n for n in (0, 1, 59, 60, 61, 1439, 1440, 100000)]
+        quora_strs += ['Added %dh ago' % n for n in (0, 1, 23, 24, 25, 48, 10000)]
+        quora_strs += ['Added just now', 'Added 12am', 'Added 11pm', 'Added  just now ']
+        self.assertAllMatchOld(origins, quora_strs)
+
+    def test_leap_days(self):
+        quora_strs = ['Added Feb 28', 'Added Feb 29', 'Added Mar 1', 'Added Feb 29, 2016', 'Added Feb 29, 2015', 'Added Feb 29, 2000', 'Added Feb 29, 1900']
+        origins = []
+        for year in (2015, 2016, 2017, 2100):
+            for month, day in ((2, 28), (2, 29), (3, 1), (3, 2)):
+                if calendar.isleap(year) or (month, day) != (2, 29):
+                    origins += [origin_at(year, month, day, 0), origin_at(year, month, day, 23)]
+        self.assertAllMatchOld(origins, quora_strs)
+        self.assertEqual(parse_quora_date(origin_at(2016, 3, 1), 'Added Feb 29'), '2016-02-29')
+        # Exactly 366 days back is still within range.
+        self.assertEqual(parse_quora_date(origin_at(2017, 3, 1), 'Added Feb 29'), '2016-02-29')
+        self.assertRaises(ValueError, parse_quora_date, origin_at(2017, 3, 2), 'Added Feb 29')
+        self.assertRaises(ValueError, parse_quora_date, origin_at(2016, 1, 1), 'Added Feb 29, 2015')
+
+    def test_invalid_days(self):
+        quora_strs = []
+        for month in MONTHS:
+            for day in ('0', '00', '1', '01', '001', '28', '29', '30', '31', '32', '99'):
+                quora_strs += ['Added %s %s' % (month, day), 'Added %s %s, 2016' % (month, day)]
+        self.assertAllMatchOld([origin_at(2016, 6, 15), origin_at(2017, 1, 1, 0)], quora_strs)
+        for quora_str in ['Added Apr 31', 'Added Jan 0', 'Added Jan 32', 'Added Apr 31, 2016', 'Added Jan 0, 2016']:
+            self.assertRaises(ValueError, parse_quora_date, origin_at(2016, 6, 15), quora_str)
+
+    def test_malformed_years(self):
+        quora_strs = ['Added Jan 5, %s' % year for year in ('2015', '15', '015', '0015', '0999', '0000', '9999', '20150', '')]
+        quora_strs += ['Added Jan 5,2015', 'Added Jan  5, 2015', 'Added Jan 5, 2015 ', 'Added jan 5, 2015', 'Added Jan 5 2015']
+        self.assertAllMatchOld([origin_at(2016, 6, 15)], quora_strs)
+
+    def test_day_of_week_wraparound(self):
+        # A whole week of origins, at both ends of the day, including a new year.
+        origins = [origin_at(2015, 12, 28, 0) + 86400*n + hour for n in range(8) for hour in (0, 86399)]
+        self.assertAllMatchOld(origins, ['Added %s' % day for day in DAYS])
+        # The same day of the week as the origin is a week earlier, never the origin itself.
+        self.assertEqual(parse_quora_date(origin_at(2016, 1, 1), 'Added Fri'), '2015-12-25')
+        self.assertEqual(parse_quora_date(origin_at(2016, 1, 1), 'Added Thu'), '2015-12-31')
+
+    def test_month_day_wraparound(self):
+        origins = [origin_at(2015, 12, 31, 23), origin_at(2016, 1, 1, 0), origin_at(2016, 1, 1, 23), origin_at(2016, 1, 2, 0), origin_at(2016, 12, 31, 12)]
+        quora_strs = ['Added Dec 30', 'Added Dec 31', 'Added Jan 1', 'Added Jan 2', 'Added Jan 3', 'Added Jun 15']
+        self.assertAllMatchOld(origins, quora_strs)
+        self.assertEqual(parse_quora_date(origin_at(2016, 1, 1), 'Added Dec 31'), '2015-12-31')
+        self.assertEqual(parse_quora_date(origin_at(2016, 1, 1), 'Added Jan 1'), '2015-01-01')
+        self.assertEqual(parse_quora_date(origin_at(2016, 1, 1), 'Added Jan 2'), '2015-01-02')
+
+    def test_random(self):
+        rng = random.Random(8)
+        for _ in range(20000):
+            origin = rng.uniform(0, 2e9)
+            kind = rng.randrange(5)
+            if kind == 0:
+                quora_str = 'Added %d%s ago' % (rng.randrange(100000), rng.choice('mh'))
+            elif kind == 1:
+                quora_str = 'Added ' + rng.choice(DAYS)
+            elif kind == 2:
+                quora_str = 'Added %s %d' % (rng.choice(MONTHS), rng.randrange(33))
+            elif kind == 3:
+                quora_str = 'Added %s %d, %d' % (rng.choice(MONTHS), rng.randrange(33), rng.randrange(1990, 2030))
+            else:
+                quora_str = rng.choice(['Added just now', 'Added %dam' % rng.randrange(13), 'Added', 'Added %s' % rng.choice(MONTHS)])
+            self.assertMatchesOld(origin, quora_str)
+
+    def test_resolver_matches_function(self):
+        origin = origin_at(2016, 2, 29, 5)
+        quora_strs = ['Added Feb 28', 'Added Mon', 'Added 7h ago', 'Added bogus']
+        self.assertEqual(DateResolver(origin).resolve_all(quora_strs, 'unknown'), ['2016-02-28', '2016-02-22', '2016-02-28', 'unknown'])
+
+class FilenameDateTest(unittest.TestCase):
+    def test_filename_date(self):
+        self.assertEqual(filename_date('2015-01-31 How-do-I.html'), '2015-01-31')
+        self.assertIsNone(filename_date('How-do-I.html'))
+
+if __name__ == '__main__':
+    unittest.main()